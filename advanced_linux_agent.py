@@ -1,17 +1,3063 @@
 import os
+import sys
+import argparse
+import asyncio
 import subprocess
 import shlex
 import json
 import re
-from enum import Enum
-from openai import OpenAI
-import google.generativeai as genai
-from typing import List, Dict
+import codecs
+import fcntl
+import glob
+import gzip
+import hashlib
+import io
+import importlib.util
+import queue
+import random
+import selectors
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from enum import Enum, IntEnum
+from typing import AsyncIterator, Callable, Iterable, Iterator, List, Dict, Optional, TextIO
 
 class AIModel(Enum):
     DEEPSEEK = "deepseek"
     GEMINI = "gemini"
 
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+def parse_json_response(text: str) -> dict:
+    """Parse a JSON reply, unwrapping a ```json fenced block if present.
+
+    Replies that still fail to parse (prose around the object, trailing
+    commas, output cut off mid-value) go through repair_json rather than a
+    second request, and are marked with "_repaired": True since steps may
+    be missing.
+    """
+    text = text.strip()
+    if text.startswith('```'):
+        text = text.split('\n', 1)[1] if '\n' in text else ''
+        text = text.rsplit('```', 1)[0]
+    try:
+        return json.loads(text)
+    except ValueError:
+        result = json.loads(repair_json(text))
+        if isinstance(result, dict):
+            result["_repaired"] = True
+        return result
+
+def repair_json(text: str) -> str:
+    """Best-effort fix-up of the first JSON object in text.
+
+    Anything outside the object is dropped, trailing commas are removed and
+    an unterminated array or object is closed. A cut-off string is closed
+    only when it is a top-level value; anywhere else the partial key, element
+    or enclosing object (say, half a command) is dropped.
+    """
+    start = text.find("{")
+    if start == -1:
+        raise ValueError("no JSON object in response")
+    stack, in_string, escape, end, string_start = [], False, False, None, start
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string, string_start = True, i
+        elif c in "{[":
+            stack.append(("}" if c == "{" else "]", i))
+        elif c in "}]" and stack:
+            stack.pop()
+            if not stack:
+                end = i + 1
+                break
+    fixed = text[start:end]
+    if end is None:
+        if in_string:
+            if len(stack) == 1 and text[start:string_start].rstrip().endswith(":"):
+                fixed = (fixed[:-1] if escape else fixed) + '"'
+            elif len(stack) > 1 and stack[-1][0] == "}":
+                fixed = text[start:stack.pop()[1]]
+            else:
+                fixed = text[start:string_start]
+        fixed = fixed.rstrip()
+        if fixed.endswith(":"):
+            fixed += "null"
+        fixed = fixed.rstrip(",") + "".join(closer for closer, _ in reversed(stack))
+    return re.sub(r',\s*([}\]])', r'\1', fixed)
+
+class JSONStreamParser:
+    """Incrementally parse a streamed JSON object reply.
+
+    feed() returns (key, index, value) events as soon as each top-level
+    value is complete; elements of top-level arrays are reported one by one
+    with their 0-based index, other values with index None. Text before the
+    opening brace, such as a ```json fence, is ignored. close() returns the
+    whole object, repaired if the stream ended early or was malformed.
+    """
+
+    def __init__(self):
+        self._text = ""
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._expect_key = False
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+        self._element_start = None
+        self._index = 0
+        self._done = False
+
+    @staticmethod
+    def iter_events(obj: dict) -> Iterator:
+        """Events for an already complete object, e.g. a cached response"""
+        for key, value in obj.items():
+            if isinstance(value, list):
+                for index, item in enumerate(value):
+                    yield key, index, item
+            else:
+                yield key, None, value
+
+    def feed(self, chunk: str) -> List:
+        events = []
+        offset = len(self._text)
+        self._text += chunk
+        if self._done:
+            return events
+        text = self._text
+        for i in range(offset, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        self._key = json.loads(text[self._key_start:i + 1])
+                        self._key_start = None
+                continue
+            depth = len(self._stack)
+            if c == '"':
+                self._in_string = True
+                if depth == 1 and self._expect_key:
+                    self._key_start, self._expect_key = i, False
+            elif c in "{[":
+                if not self._stack and c == "[":
+                    continue
+                self._stack.append(c)
+                if depth == 0:
+                    self._expect_key = True
+                elif depth == 1 and c == "[":
+                    self._value_start, self._index = None, 0
+                    self._element_start = i + 1
+            elif depth == 1 and c == ":":
+                self._value_start = i + 1
+            elif c == "," and depth == 1:
+                self._finish_value(text, i, events)
+                self._expect_key = True
+            elif c == "," and depth == 2 and self._stack[1] == "[":
+                self._finish_element(text, i, events)
+            elif c in "}]" and self._stack:
+                if depth == 2 and self._stack[1] == "[" and c == "]":
+                    self._finish_element(text, i, events)
+                elif depth == 1:
+                    self._finish_value(text, i, events)
+                    self._done = True
+                self._stack.pop()
+                if self._done:
+                    break
+        return events
+
+    def close(self) -> dict:
+        return parse_json_response(self._text)
+
+    def _finish_value(self, text: str, end: int, events: List):
+        if self._value_start is not None and self._key is not None:
+            self._emit(events, text[self._value_start:end], None)
+        self._key = self._value_start = None
+
+    def _finish_element(self, text: str, end: int, events: List):
+        if self._emit(events, text[self._element_start:end], self._index):
+            self._index += 1
+        self._element_start = end + 1
+
+    def _emit(self, events: List, raw: str, index: Optional[int]) -> bool:
+        raw = raw.strip()
+        if not raw:
+            return False
+        try:
+            events.append((self._key, index, json.loads(raw)))
+        except ValueError:
+            # Left to the repair pass in close()
+            pass
+        return True
+
+class Metrics:
+    """Session latency, token and command counters.
+
+    Recent events are kept in memory for percentiles in the `stats` command;
+    running totals back the Prometheus textfile. Each event is also appended
+    to a JSONL file when jsonl_path is set.
+    """
+
+    def __init__(self, jsonl_path: Optional[str] = None, prom_path: Optional[str] = None,
+                 max_events: int = 10000):
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.events = deque(maxlen=max_events)
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def record_ai_call(self, provider: str, kind: str, duration: float, ttft: Optional[float] = None,
+                       prompt_tokens: Optional[int] = None, completion_tokens: Optional[int] = None,
+                       cache_hit: bool = False, error: bool = False):
+        self._record({
+            "type": "ai", "provider": provider, "kind": kind, "duration": duration, "ttft": ttft,
+            "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "cache_hit": cache_hit, "error": error,
+        })
+
+    def record_command(self, result: "CommandResult"):
+        self._record({
+            "type": "command", "duration": result.duration, "output_bytes": result.output_bytes,
+            "exit_code": result.exit_code,
+        })
+
+    def _record(self, event: Dict):
+        event["ts"] = time.time()
+        with self._lock:
+            self.events.append(event)
+            self._add_totals(event)
+            if self.jsonl_path:
+                try:
+                    with open(self.jsonl_path, "a") as f:
+                        f.write(json.dumps(event) + "\n")
+                except OSError:
+                    pass
+            if self.prom_path:
+                self._write_prometheus()
+
+    def _add_totals(self, event: Dict):
+        def add(name, labels, value):
+            key = (name, labels)
+            self.totals[key] = self.totals.get(key, 0) + value
+
+        if event["type"] == "ai":
+            labels = f'provider="{event["provider"]}",kind="{event["kind"]}"'
+            add("assistant_ai_requests_total", labels + f',cache_hit="{str(event["cache_hit"]).lower()}",error="{str(event["error"]).lower()}"', 1)
+            if event["cache_hit"]:
+                return
+            add("assistant_ai_request_seconds_sum", labels, event["duration"])
+            add("assistant_ai_request_seconds_count", labels, 1)
+            if event["ttft"] is not None:
+                add("assistant_ai_first_token_seconds_sum", labels, event["ttft"])
+                add("assistant_ai_first_token_seconds_count", labels, 1)
+            for kind in ("prompt", "completion"):
+                if event[f"{kind}_tokens"]:
+                    add("assistant_ai_tokens_total", f'provider="{event["provider"]}",type="{kind}"', event[f"{kind}_tokens"])
+        else:
+            status = "ok" if event["exit_code"] == 0 else "failed"
+            add("assistant_commands_total", f'status="{status}"', 1)
+            add("assistant_command_seconds_sum", "", event["duration"])
+            add("assistant_command_output_bytes_total", "", event["output_bytes"])
+
+    def _write_prometheus(self):
+        lines = [f"{name}{{{labels}}} {value}" if labels else f"{name} {value}"
+                 for (name, labels), value in sorted(self.totals.items())]
+        tmp = f"{self.prom_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp, self.prom_path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def percentile(values: List[float], pct: float) -> float:
+        values = sorted(values)
+        return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+    def summary(self) -> List[str]:
+        """Human-readable report lines for the `stats` command"""
+        with self._lock:
+            events = list(self.events)
+        ai = [e for e in events if e["type"] == "ai"]
+        commands = [e for e in events if e["type"] == "command"]
+        lines = []
+        hits = sum(e["cache_hit"] for e in ai)
+        errors = sum(e["error"] for e in ai)
+        lines.append(f"AI calls: {len(ai)} ({hits} cache hits, {errors} errors)")
+        groups = {}
+        for e in ai:
+            if not e["cache_hit"]:
+                groups.setdefault((e["provider"], e["kind"]), []).append(e)
+        for (provider, kind), group in sorted(groups.items()):
+            durations = [e["duration"] for e in group]
+            line = (f"  {provider} {kind}: n={len(group)} p50={self.percentile(durations, 50):.2f}s "
+                    f"p95={self.percentile(durations, 95):.2f}s")
+            ttfts = [e["ttft"] for e in group if e["ttft"] is not None]
+            if ttfts:
+                line += f" first-token p50={self.percentile(ttfts, 50):.2f}s"
+            prompt = sum(e["prompt_tokens"] or 0 for e in group)
+            completion = sum(e["completion_tokens"] or 0 for e in group)
+            if prompt or completion:
+                line += f" tokens {prompt} in / {completion} out"
+            lines.append(line)
+        failed = sum(e["exit_code"] != 0 for e in commands)
+        runtime = sum(e["duration"] for e in commands)
+        output = sum(e["output_bytes"] for e in commands)
+        lines.append(f"Commands: {len(commands)} run, {failed} failed, {runtime:.2f}s total, {human_size(output)} output")
+        if commands:
+            durations = [e["duration"] for e in commands]
+            lines.append(f"  runtime p50={self.percentile(durations, 50):.2f}s p95={self.percentile(durations, 95):.2f}s "
+                         f"max={max(durations):.2f}s")
+        return lines
+
+class AsyncLoop:
+    """Background asyncio event loop shared by all provider requests.
+
+    Synchronous REPL code submits coroutines and gets concurrent futures
+    back, so requests can be started early and awaited later.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="ai-loop", daemon=True)
+        self._thread.start()
+
+    def submit(self, coro) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def iterate(self, agen: AsyncIterator) -> Iterator:
+        """Consume an async generator from synchronous code, cancelling it if abandoned"""
+        items = queue.Queue()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    items.put((True, item))
+                items.put((False, None))
+            except Exception as e:
+                items.put((False, e))
+
+        future = self.submit(pump())
+        try:
+            while True:
+                ok, item = items.get()
+                if not ok:
+                    if item is not None:
+                        raise item
+                    return
+                yield item
+        finally:
+            future.cancel()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=2)
+
+class AIProvider:
+    """Async chat provider; messages use the OpenAI chat format.
+
+    Transient failures are retried with exponential backoff and full jitter.
+    A stream is only retried if it fails before its first chunk.
+    """
+
+    name = ""
+    RETRY_BASE_DELAY = 0.5
+    RETRY_MAX_DELAY = 8.0
+
+    def __init__(self, api_key: str, model_name: str, timeout: float = 60.0, max_retries: int = 3,
+                 metrics: Optional[Metrics] = None):
+        self.api_key = api_key
+        self.model_name = model_name
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.metrics = metrics
+
+    async def complete(self, messages: List[Dict], json_mode: bool = False) -> str:
+        start = time.monotonic()
+        usage = {}
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    text = await self._complete(messages, json_mode, usage)
+                    break
+                except Exception as e:
+                    if attempt >= self.max_retries or not self.is_retryable(e):
+                        raise
+                    await asyncio.sleep(self.backoff(attempt))
+        except asyncio.CancelledError:
+            # Abandoned, e.g. the losing side of a hedged request; not a failure
+            raise
+        except BaseException:
+            self.record("complete", start, usage, error=True)
+            raise
+        self.record("complete", start, usage)
+        return text
+
+    async def stream(self, messages: List[Dict], json_mode: bool = False) -> AsyncIterator[str]:
+        start = time.monotonic()
+        first_token = None
+        usage = {}
+        attempt = 0
+        try:
+            while True:
+                try:
+                    async for text in self._stream(messages, usage, json_mode):
+                        if first_token is None:
+                            first_token = time.monotonic() - start
+                        yield text
+                    break
+                except Exception as e:
+                    if first_token is not None or attempt >= self.max_retries or not self.is_retryable(e):
+                        raise
+                    await asyncio.sleep(self.backoff(attempt))
+                    attempt += 1
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            self.record("stream", start, usage, first_token, error=True)
+            raise
+        self.record("stream", start, usage, first_token)
+
+    def record(self, kind: str, start: float, usage: Dict, first_token: Optional[float] = None,
+               error: bool = False):
+        if self.metrics:
+            self.metrics.record_ai_call(self.name, kind, time.monotonic() - start, first_token,
+                                        usage.get("prompt_tokens"), usage.get("completion_tokens"),
+                                        error=error)
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.RETRY_MAX_DELAY, self.RETRY_BASE_DELAY * 2 ** attempt))
+
+    def is_retryable(self, error: Exception) -> bool:
+        return isinstance(error, (asyncio.TimeoutError, ConnectionError))
+
+    async def _complete(self, messages: List[Dict], json_mode: bool, usage: Dict) -> str:
+        """Return the reply text, filling usage with prompt/completion token counts"""
+        raise NotImplementedError
+
+    async def _stream(self, messages: List[Dict], usage: Dict, json_mode: bool = False) -> AsyncIterator[str]:
+        """Yield reply chunks, filling usage with token counts when the provider reports them"""
+        raise NotImplementedError
+        yield
+
+    async def warm_up(self):
+        """Import the SDK and build the client ahead of the first request"""
+
+    async def aclose(self):
+        pass
+
+class DeepSeekProvider(AIProvider):
+    """DeepSeek through its OpenAI-compatible API.
+
+    One pooled httpx client keeps connections alive between requests and
+    negotiates HTTP/2 when the h2 package is installed. DEEPSEEK_BASE_URL
+    points it at another endpoint, such as a local mock server.
+    """
+
+    name = "deepseek"
+
+    def __init__(self, api_key: str, model_name: str = "deepseek-chat", base_url: Optional[str] = None, **kwargs):
+        super().__init__(api_key, model_name, **kwargs)
+        self.base_url = base_url or os.environ.get("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
+        self._client = None
+
+    async def get_client(self):
+        if self._client is None:
+            # The SDK import runs in a worker thread so it does not stall other requests on this loop
+            await asyncio.get_running_loop().run_in_executor(None, importlib.import_module, "openai")
+        # Created on first use so the httpx pool binds to the provider loop
+        if self._client is None:
+            import httpx
+            import openai
+            http_client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                timeout=httpx.Timeout(self.timeout, connect=10.0),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=120),
+            )
+            self._client = openai.AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                              http_client=http_client, max_retries=0)
+        return self._client
+
+    @staticmethod
+    def _read_usage(source, usage: Dict):
+        if getattr(source, "usage", None):
+            usage["prompt_tokens"] = source.usage.prompt_tokens
+            usage["completion_tokens"] = source.usage.completion_tokens
+
+    async def _complete(self, messages: List[Dict], json_mode: bool, usage: Dict) -> str:
+        extra = {"response_format": {"type": "json_object"}} if json_mode else {}
+        client = await self.get_client()
+        response = await client.chat.completions.create(model=self.model_name, messages=messages, **extra)
+        self._read_usage(response, usage)
+        return response.choices[0].message.content
+
+    async def _stream(self, messages: List[Dict], usage: Dict, json_mode: bool = False) -> AsyncIterator[str]:
+        extra = {"response_format": {"type": "json_object"}} if json_mode else {}
+        client = await self.get_client()
+        stream = await client.chat.completions.create(model=self.model_name, messages=messages, stream=True,
+                                                      stream_options={"include_usage": True}, **extra)
+        async for chunk in stream:
+            self._read_usage(chunk, usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def is_retryable(self, error: Exception) -> bool:
+        import openai
+        return isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)) \
+            or super().is_retryable(error)
+
+    async def warm_up(self):
+        await self.get_client()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+class GeminiProvider(AIProvider):
+    """Google Gemini through the async google-generativeai client (gRPC, HTTP/2)"""
+
+    name = "gemini"
+
+    def __init__(self, api_key: str, model_name: str = "gemini-2.5-pro-exp-03-25", **kwargs):
+        super().__init__(api_key, model_name, **kwargs)
+        self._genai = None
+
+    async def get_genai(self):
+        # The SDK pulls in gRPC and protobuf; import it only once Gemini is used, and in a
+        # worker thread so the import does not stall other requests on this loop
+        if self._genai is None:
+            self._genai = await asyncio.get_running_loop().run_in_executor(None, self._load_sdk)
+        return self._genai
+
+    def _load_sdk(self):
+        import google.generativeai as genai
+        genai.configure(api_key=self.api_key)
+        return genai
+
+    async def warm_up(self):
+        await self.get_genai()
+
+    async def _prepare(self, messages: List[Dict]):
+        system = "\n".join(m["content"] for m in messages if m["role"] == "system")
+        contents = [
+            {"role": "model" if m["role"] == "assistant" else "user", "parts": [m["content"]]}
+            for m in messages if m["role"] != "system"
+        ]
+        genai = await self.get_genai()
+        return genai.GenerativeModel(self.model_name, system_instruction=system or None), contents
+
+    @staticmethod
+    def _read_usage(source, usage: Dict):
+        metadata = getattr(source, "usage_metadata", None)
+        if metadata and metadata.prompt_token_count:
+            usage["prompt_tokens"] = metadata.prompt_token_count
+            usage["completion_tokens"] = metadata.candidates_token_count
+
+    async def _complete(self, messages: List[Dict], json_mode: bool, usage: Dict) -> str:
+        model, contents = await self._prepare(messages)
+        config = {"response_mime_type": "application/json"} if json_mode else None
+        response = await model.generate_content_async(contents, generation_config=config,
+                                                       request_options={"timeout": self.timeout})
+        self._read_usage(response, usage)
+        return response.text
+
+    async def _stream(self, messages: List[Dict], usage: Dict, json_mode: bool = False) -> AsyncIterator[str]:
+        model, contents = await self._prepare(messages)
+        config = {"response_mime_type": "application/json"} if json_mode else None
+        response = await model.generate_content_async(contents, stream=True, generation_config=config,
+                                                       request_options={"timeout": self.timeout})
+        async for chunk in response:
+            self._read_usage(chunk, usage)
+            if chunk.text:
+                yield chunk.text
+
+    def is_retryable(self, error: Exception) -> bool:
+        from google.api_core import exceptions as google_exceptions
+        return isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable,
+                                  google_exceptions.DeadlineExceeded, google_exceptions.InternalServerError)) \
+            or super().is_retryable(error)
+
+class FakeProvider(AIProvider):
+    """In-process stand-in for a model, used by the --check-* commands.
+
+    Answers with reply (a string, or a function of the messages) after
+    delay seconds; a stream yields its first chunk after first_token
+    seconds and the rest by delay. With fail set, that exception is raised
+    after first_token seconds instead.
+    """
+
+    def __init__(self, name: str = "fake", reply="{}", delay: float = 0.0,
+                 first_token: Optional[float] = None, fail: Optional[Exception] = None,
+                 chunks: int = 4, **kwargs):
+        kwargs.setdefault("max_retries", 0)
+        super().__init__("", name, **kwargs)
+        self.name = name
+        self.reply = reply
+        self.delay = delay
+        self.first_token = delay if first_token is None else first_token
+        self.fail = fail
+        self.chunks = max(1, chunks)
+        self.calls = 0
+        self.cancelled = 0
+
+    def _reply(self, messages: List[Dict], usage: Dict) -> str:
+        text = self.reply(messages) if callable(self.reply) else self.reply
+        usage["prompt_tokens"] = sum(len(m["content"]) for m in messages) // 4
+        usage["completion_tokens"] = len(text) // 4
+        return text
+
+    async def _sleep(self, seconds: float):
+        try:
+            await asyncio.sleep(seconds)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+    async def _complete(self, messages: List[Dict], json_mode: bool, usage: Dict) -> str:
+        self.calls += 1
+        await self._sleep(self.first_token if self.fail else self.delay)
+        if self.fail:
+            raise self.fail
+        return self._reply(messages, usage)
+
+    async def _stream(self, messages: List[Dict], usage: Dict, json_mode: bool = False) -> AsyncIterator[str]:
+        self.calls += 1
+        await self._sleep(self.first_token)
+        if self.fail:
+            raise self.fail
+        text = self._reply(messages, usage)
+        size = -(-len(text) // self.chunks)
+        for i in range(0, len(text), size):
+            if i:
+                await self._sleep((self.delay - self.first_token) / self.chunks)
+            yield text[i:i + size]
+
+PROVIDERS = {
+    AIModel.DEEPSEEK: DeepSeekProvider,
+    AIModel.GEMINI: GeminiProvider,
+}
+
+class ProviderRouter:
+    """Send each request to the best configured provider, hedging and failing over.
+
+    Providers are tried in order: the selected model first, or in auto mode
+    the healthiest one with the lowest recent p95 latency. If the first has
+    not answered (or, for a stream, produced its first chunk) within the
+    hedge threshold, the next one is started too; the first to respond wins
+    and the other is cancelled. An error moves on to the next provider
+    straight away. Once a stream has yielded it is never switched, so output
+    is not duplicated. Without a fixed hedge_after the threshold is the
+    provider's recent p95, clamped to HEDGE_BOUNDS. A cancelled loser's
+    elapsed time is kept as a lower bound of its latency.
+    """
+
+    HEDGE_BOUNDS = {"stream": (1.0, 10.0), "complete": (2.0, 30.0)}
+    MIN_SAMPLES = 5
+
+    def __init__(self, providers: Dict, preferred: Callable[[], AIModel], hedge_after: Optional[float] = None,
+                 hedging: bool = True, window: int = 50):
+        # Shared with the caller, so providers configured later are picked up
+        self.providers = providers
+        self.preferred = preferred
+        self.hedge_after = hedge_after
+        self.hedging = hedging
+        self.auto = False
+        self.window = window
+        self.latency = {}
+        self.outcomes = {}
+        self.hedges = 0
+        self.failovers = 0
+        self.backup_wins = 0
+
+    def order(self) -> List[AIModel]:
+        preferred = self.preferred()
+        models = sorted(self.providers, key=lambda m: m != preferred)
+        if self.auto:
+            models.sort(key=self._rank)
+        if not models:
+            raise RuntimeError("No AI provider is configured")
+        return models
+
+    def _rank(self, model: AIModel):
+        outcomes = self.outcomes.get(model, ())
+        unhealthy = len(outcomes) >= 3 and sum(outcomes) / len(outcomes) > 0.5
+        for kind in ("stream", "complete"):
+            samples = self.latency.get((model, kind))
+            if samples and len(samples) >= self.MIN_SAMPLES:
+                return unhealthy, Metrics.percentile(list(samples), 95)
+        # Not enough data yet: try it so it gets measured
+        return unhealthy, 0.0
+
+    def threshold(self, model: AIModel, kind: str) -> float:
+        if self.hedge_after is not None:
+            return self.hedge_after
+        low, high = self.HEDGE_BOUNDS[kind]
+        samples = self.latency.get((model, kind))
+        if not samples or len(samples) < self.MIN_SAMPLES:
+            return high
+        return min(high, max(low, Metrics.percentile(list(samples), 95)))
+
+    def observe(self, model: AIModel, kind: str, seconds: Optional[float] = None):
+        """Record a response time, or a failure when seconds is None"""
+        self.outcomes.setdefault(model, deque(maxlen=10)).append(seconds is None)
+        if seconds is not None:
+            self.latency.setdefault((model, kind), deque(maxlen=self.window)).append(seconds)
+
+    def _hedge_timeout(self, started: Dict, waiting: int, remaining: List, kind: str) -> Optional[float]:
+        if not self.hedging or not remaining or waiting != 1:
+            return None
+        (model, start), = started.items()
+        return max(0.0, start + self.threshold(model, kind) - time.monotonic())
+
+    async def complete(self, messages: List[Dict], json_mode: bool = False) -> str:
+        models = self.order()
+        remaining = list(models)
+        running, started = {}, {}
+        last_error = None
+
+        def launch():
+            model = remaining.pop(0)
+            started[model] = time.monotonic()
+            running[asyncio.ensure_future(self.providers[model].complete(messages, json_mode))] = model
+
+        launch()
+        try:
+            while running:
+                waiting = {m: started[m] for m in running.values()}
+                timeout = self._hedge_timeout(waiting, len(running), remaining, "complete")
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.hedges += 1
+                    launch()
+                    continue
+                for task in done:
+                    model = running.pop(task)
+                    if task.exception() is None:
+                        self.observe(model, "complete", time.monotonic() - started[model])
+                        if model != models[0]:
+                            self.backup_wins += 1
+                        return task.result()
+                    last_error = task.exception()
+                    self.observe(model, "complete")
+                if not running and remaining:
+                    self.failovers += 1
+                    launch()
+            raise last_error
+        finally:
+            for task, model in running.items():
+                task.cancel()
+                self.observe(model, "complete", time.monotonic() - started[model])
+            # Let the losers unwind, as stream() does, so they release their connections
+            await asyncio.gather(*running, return_exceptions=True)
+
+    async def stream(self, messages: List[Dict], json_mode: bool = False) -> AsyncIterator[str]:
+        models = self.order()
+        remaining = list(models)
+        streams, started, pending = {}, {}, {}
+        winner, first, last_error = None, "", None
+
+        def launch():
+            model = remaining.pop(0)
+            started[model] = time.monotonic()
+            streams[model] = self.providers[model].stream(messages, json_mode)
+            pending[asyncio.ensure_future(streams[model].__anext__())] = model
+
+        launch()
+        try:
+            while pending and winner is None:
+                waiting = {m: started[m] for m in pending.values()}
+                timeout = self._hedge_timeout(waiting, len(pending), remaining, "stream")
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.hedges += 1
+                    launch()
+                    continue
+                for task in done:
+                    model = pending.pop(task)
+                    error = task.exception()
+                    if error is None or isinstance(error, StopAsyncIteration):
+                        winner, first = model, task.result() if error is None else ""
+                        break
+                    last_error = error
+                    self.observe(model, "stream")
+                if winner is None and not pending and remaining:
+                    self.failovers += 1
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        if winner is None:
+            raise last_error
+        # Let the losers unwind before this stream continues
+        await asyncio.gather(*pending, return_exceptions=True)
+        for model in pending.values():
+            self.observe(model, "stream", time.monotonic() - started[model])
+            await streams[model].aclose()
+        self.observe(winner, "stream", time.monotonic() - started[winner])
+        if winner != models[0]:
+            self.backup_wins += 1
+
+        agen = streams[winner]
+        try:
+            if first:
+                yield first
+            async for chunk in agen:
+                yield chunk
+        finally:
+            await agen.aclose()
+
+    def summary(self) -> str:
+        order = ", ".join(m.value for m in self.order()) if self.providers else "none"
+        return (f"Routing ({'auto' if self.auto else 'selected model first'}): {order}; "
+                f"{self.hedges} hedged, {self.failovers} failed over, {self.backup_wins} answered by a backup")
+
+def human_size(num_bytes: float) -> str:
+    """Format a byte count the way `free -h` does (e.g. 5.9Gi)"""
+    for unit in ("B", "Ki", "Mi", "Gi", "Ti"):
+        if num_bytes < 1024 or unit == "Ti":
+            return f"{num_bytes:.0f}{unit}" if unit == "B" else f"{num_bytes:.1f}{unit}"
+        num_bytes /= 1024
+
+class SystemContext(Mapping):
+    """Lazily collected system facts with a per-field TTL.
+
+    Cheap facts are read straight from /proc and /etc; the probes that need
+    a subprocess (systemctl, ip) run concurrently in a small thread pool.
+    A TTL of None means the value never expires.
+    """
+
+    PROBE_TIMEOUT = 5
+    PSEUDO_FILESYSTEMS = {
+        "proc", "sysfs", "devpts", "cgroup", "cgroup2", "securityfs", "pstore",
+        "debugfs", "tracefs", "configfs", "fusectl", "mqueue", "hugetlbfs",
+        "bpf", "autofs", "binfmt_misc", "rpc_pipefs", "nsfs", "squashfs",
+    }
+    CRITICAL_SERVICES = re.compile(r"(ssh|nginx|apache|postgres|mysql)")
+    # Programs that can change a field before its TTL runs out
+    CHANGED_BY = {
+        "disk_space": {"mount", "umount", "swapon", "swapoff", "lvextend", "resize2fs", "xfs_growfs"},
+        "network_ips": {"ip", "ifconfig", "ifup", "ifdown", "nmcli", "dhclient", "netplan", "networkctl"},
+        "critical_services": {"systemctl", "service"},
+    }
+
+    def __init__(self, work_dir: Callable[[], str], max_workers: int = 4):
+        self._fields = {
+            "os": (self._read_os_name, None),
+            "work_dir": (work_dir, 0),
+            "package_manager": (self._detect_package_manager, None),
+            "critical_services": (self._probe_services, 300),
+            "disk_space": (self._read_disk_space, 60),
+            "network_ips": (self._probe_network_ips, 300),
+            "cpu_cores": (os.cpu_count, None),
+            "memory_total": (lambda: self._read_meminfo("MemTotal"), None),
+            "memory_available": (lambda: self._read_meminfo("MemAvailable"), 30),
+            "essential_env_vars": (self._read_env_vars, None),
+        }
+        self._slow_fields = {"critical_services", "network_ips"}
+        self._values = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sysctx")
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        loader, ttl = self._fields[key]
+        if ttl == 0:
+            return loader()
+        with self._lock:
+            cached = self._values.get(key)
+            if cached and (ttl is None or time.monotonic() - cached[1] < ttl):
+                return cached[0]
+            future = self._pending.get(key) or self._submit(key)
+        return future.result()
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def prefetch(self):
+        """Start refreshing every stale subprocess-backed field in the background"""
+        now = time.monotonic()
+        with self._lock:
+            for key in self._slow_fields:
+                cached = self._values.get(key)
+                ttl = self._fields[key][1]
+                if key not in self._pending and (not cached or now - cached[1] >= ttl):
+                    self._submit(key)
+
+    def invalidate(self, *keys: str):
+        """Drop cached values so the next lookup collects them again"""
+        with self._lock:
+            for key in keys or list(self._values):
+                self._values.pop(key, None)
+
+    def invalidate_after(self, programs: Iterable[str]):
+        """Drop the fields that the given programs may have changed"""
+        names = {os.path.basename(program) for program in programs}
+        stale = [key for key, changers in self.CHANGED_BY.items() if names & changers]
+        if stale:
+            self.invalidate(*stale)
+
+    def snapshot(self) -> Dict:
+        """Resolve every field, waiting on the concurrent probes together"""
+        self.prefetch()
+        return {key: self[key] for key in self._fields}
+
+    def _submit(self, key: str):
+        # Caller holds self._lock
+        future = self._pool.submit(self._load, key)
+        self._pending[key] = future
+        return future
+
+    def _load(self, key: str):
+        loader = self._fields[key][0]
+        try:
+            value = loader()
+        except Exception as e:
+            value = f"unavailable ({e})"
+        with self._lock:
+            self._values[key] = (value, time.monotonic())
+            self._pending.pop(key, None)
+        return value
+
+    def _run_probe(self, args: List[str]) -> str:
+        result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                text=True, timeout=self.PROBE_TIMEOUT)
+        return result.stdout
+
+    def _read_os_name(self) -> str:
+        for path in ("/etc/os-release", "/usr/lib/os-release"):
+            try:
+                with open(path) as f:
+                    for line in f:
+                        if line.startswith("PRETTY_NAME="):
+                            return line.split("=", 1)[1].strip().strip('"')
+            except OSError:
+                continue
+        return os.uname().sysname
+
+    def _detect_package_manager(self) -> str:
+        return "apt" if os.path.exists("/usr/bin/apt") else "rpm"
+
+    def _read_meminfo(self, field: str) -> str:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return human_size(int(line.split()[1]) * 1024)
+        return "unknown"
+
+    def _read_disk_space(self) -> str:
+        lines = ["Filesystem Use% Mounted on"]
+        seen = set()
+        with open("/proc/mounts") as f:
+            mounts = [line.split()[:3] for line in f]
+        for source, target, fstype in mounts:
+            target = target.replace("\\040", " ")
+            if fstype in self.PSEUDO_FILESYSTEMS or "snap" in source or target in seen:
+                continue
+            try:
+                st = os.statvfs(target)
+            except OSError:
+                continue
+            if st.f_blocks == 0:
+                continue
+            seen.add(target)
+            used = st.f_blocks - st.f_bfree
+            usable = used + st.f_bavail
+            pcent = -(-used * 100 // usable) if usable else 0
+            lines.append(f"{source} {pcent}% {target}")
+        return "\n".join(lines)
+
+    def _probe_services(self) -> str:
+        output = self._run_probe(["systemctl", "list-units", "--type=service",
+                                  "--state=running", "--no-legend", "--plain"])
+        units = [line.split()[0] for line in output.splitlines() if line.strip()]
+        return "\n".join(u for u in units if self.CRITICAL_SERVICES.search(u))
+
+    def _probe_network_ips(self) -> str:
+        output = self._run_probe(["ip", "-brief", "address"])
+        return "\n".join(" ".join(parts[:1] + parts[2:3]) for parts in map(str.split, output.splitlines()) if parts)
+
+    def _read_env_vars(self) -> str:
+        return "\n".join([f"{k}=[...]" if len(v) > 50 else f"{k}={v}" for k,v in os.environ.items() if k in {'PATH','USER','HOME','LANG'}])
+
+class MarkdownStreamRenderer:
+    """Strip markdown from streamed text as it arrives.
+
+    A small state machine handles code fences (fence lines are dropped and
+    the code kept), bold markers, inline code and "* " bullets, holding back
+    only the few characters that are ambiguous at a chunk boundary. Output
+    is coalesced and written once a line completes, the buffer reaches
+    flush_size or flush_interval has passed, rather than once per chunk.
+    """
+
+    PLAIN = re.compile(r"[^`*\n]+")
+
+    def __init__(self, write: Optional[Callable[[str], None]] = None, code_style: str = "",
+                 text_style: str = "", flush_size: int = 512, flush_interval: float = 0.05):
+        self.write = write
+        self.code_style = code_style
+        self.text_style = text_style
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._pending = ""
+        self._line_start = True
+        self._in_fence = False
+        self._skip_line = False
+        self._in_span = False
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+
+    @classmethod
+    def render(cls, text: str) -> str:
+        """Strip markdown from a complete string in one pass"""
+        parts = []
+        renderer = cls(parts.append)
+        renderer.feed(text)
+        renderer.close()
+        return "".join(parts)
+
+    def feed(self, chunk: str):
+        self._emit(self._process(self._pending + chunk, final=False))
+
+    def close(self):
+        self._emit(self._process(self._pending, final=True))
+        if self._in_fence and self.code_style:
+            self._emit(self.text_style)
+        self.flush()
+
+    def flush(self):
+        if self._buffer:
+            text = "".join(self._buffer)
+            self._buffer, self._buffered = [], 0
+            if self.write:
+                self.write(text)
+            else:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+        self._last_flush = time.monotonic()
+
+    def _emit(self, text: str):
+        if not text:
+            return
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if ("\n" in text or self._buffered >= self.flush_size
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def _process(self, text: str, final: bool) -> str:
+        self._pending = ""
+        out, i, n = [], 0, len(text)
+        while i < n:
+            if self._skip_line:
+                # Rest of a fence line (e.g. the language tag)
+                j = text.find("\n", i)
+                if j == -1:
+                    break
+                i, self._skip_line, self._line_start = j + 1, False, True
+                continue
+            if self._line_start:
+                rest = text[i:]
+                stripped = rest.lstrip(" ")
+                indent = len(rest) - len(stripped)
+                if not final and stripped in ("", "`", "``", "*"):
+                    self._pending = rest
+                    break
+                self._line_start = False
+                if stripped.startswith("```"):
+                    self._in_fence = not self._in_fence
+                    out.append(self.code_style if self._in_fence else self.text_style)
+                    self._skip_line = True
+                    i += indent + 3
+                    continue
+                if not self._in_fence and stripped.startswith("* "):
+                    out.append(rest[:indent] + "- ")
+                    i += indent + 2
+                    continue
+            c = text[i]
+            if c == "\n":
+                out.append(c)
+                self._line_start = True
+                i += 1
+            elif self._in_fence:
+                j = text.find("\n", i)
+                j = n if j == -1 else j
+                out.append(text[i:j])
+                i = j
+            elif c == "`":
+                self._in_span = not self._in_span
+                i += 1
+            elif c == "*" and not self._in_span:
+                if i + 1 == n and not final:
+                    self._pending = "*"
+                    break
+                if i + 1 < n and text[i + 1] == "*":
+                    i += 2
+                else:
+                    out.append(c)
+                    i += 1
+            else:
+                match = self.PLAIN.match(text, i)
+                end = match.end() if match else i + 1
+                out.append(text[i:end])
+                i = end
+        return "".join(out)
+
+class RiskLevel(IntEnum):
+    SAFE = 0
+    LOW = 1
+    MEDIUM = 2
+    HIGH = 3
+    CRITICAL = 4
+
+class CommandRisk:
+    """Highest risk found in a command line and the rules that produced it"""
+    __slots__ = ("level", "reasons")
+
+    def __init__(self, level: RiskLevel = RiskLevel.SAFE, reasons: Optional[List[str]] = None):
+        self.level = level
+        self.reasons = reasons or []
+
+    def add(self, level: RiskLevel, reason: str):
+        if level > self.level:
+            self.level = level
+        if level >= RiskLevel.MEDIUM and reason not in self.reasons:
+            self.reasons.append(reason)
+
+class CommandRule:
+    """Risk rule for one program.
+
+    flags is a list of alternative groups; every group needs at least one
+    member present (single letters are short flags, "--x" long flags).
+    target must match one operand and args one raw argument, when given.
+    """
+    __slots__ = ("level", "reason", "flags", "target", "args")
+
+    def __init__(self, level: RiskLevel, reason: str, flags=(), target: Optional[str] = None,
+                 args: Optional[str] = None):
+        self.level = level
+        self.reason = reason
+        self.flags = [frozenset(group) for group in flags]
+        self.target = re.compile(target) if target else None
+        self.args = re.compile(args) if args else None
+
+    def matches(self, options: set, operands: List[str], argv: List[str]) -> bool:
+        return (all(group & options for group in self.flags)
+                and (self.target is None or any(self.target.search(o) for o in operands))
+                and (self.args is None or any(self.args.search(a) for a in argv)))
+
+class CommandClassifier:
+    """Tokenizer-based dangerous-command detection.
+
+    A command line is split with shlex into simple commands at pipes, lists
+    and subshell boundaries. Wrappers such as sudo, env or nohup are
+    skipped using each wrapper's own option table, reserved words such as
+    `do` or `then` are looked past, and `sh -c`, `su -c`, `env -S`, eval
+    strings and find's -exec commands are classified recursively. Each simple
+    command is matched only against the rules for its program, plus
+    redirections and curl-to-shell pipelines.
+    """
+
+    SYSTEM_PATH = r"^(/|/\*|~/?\*?|\$HOME/?\*?|/(bin|boot|dev|etc|home|lib|lib64|opt|root|sbin|srv|sys|usr|var)/?\*?)$"
+    BLOCK_DEVICE = r"^/dev/(sd|hd|vd|xvd|nvme|mmcblk|md|dm-|mapper/|disk/)"
+    RECURSIVE = ("r", "R", "--recursive")
+    SEPARATORS = {"|", "||", "&&", ";", "&", "(", ")", ";;", "|&", "{", "}", "$(", "`"}
+    # Wrapper -> options that take a value (short letters and long names)
+    WRAPPERS = {
+        "sudo": ("ugCDhprRtTU", {"--user", "--group", "--close-from", "--chdir", "--host", "--prompt",
+                                 "--role", "--chroot", "--type", "--command-timeout", "--other-user"}),
+        "doas": ("uC", set()),
+        "env": ("uCS", {"--unset", "--chdir", "--split-string"}),
+        "nohup": ("", set()),
+        "time": ("fo", {"--format", "--output"}),
+        "nice": ("n", {"--adjustment"}),
+        "ionice": ("cnp", {"--class", "--classdata", "--pid"}),
+        "exec": ("a", set()),
+        "command": ("", set()),
+        "builtin": ("", set()),
+        "xargs": ("adEILnPs", {"--arg-file", "--delimiter", "--max-lines", "--max-args", "--max-procs",
+                               "--max-chars", "--process-slot-var"}),
+        "timeout": ("sk", {"--signal", "--kill-after"}),
+        "stdbuf": ("ioe", {"--input", "--output", "--error"}),
+        "chrt": ("TPD", {"--sched-runtime", "--sched-period", "--sched-deadline"}),
+        "taskset": ("", set()),
+    }
+    # Wrappers followed by a positional operand (duration, priority, CPU mask) before the command
+    WRAPPER_OPERAND = {"timeout", "chrt", "taskset"}
+    SHELLS = {"sh", "bash", "dash", "zsh", "ksh"}
+    # Reserved words that may precede a command, and ones that never introduce one
+    KEYWORDS = {"if", "then", "elif", "else", "do", "while", "until", "!"}
+    HEADERS = {"for", "select", "case", "in", "fi", "done", "esac", "function"}
+    FIND_EXEC = {"-exec", "-execdir", "-ok", "-okdir"}
+    ESCALATORS = {"sudo", "doas", "su", "pkexec", "run0"}
+    PACKAGE_MANAGERS = {"apt", "apt-get", "aptitude", "dnf", "yum", "zypper", "apk", "pacman", "snap",
+                        "flatpak", "pip", "pip3", "npm", "gem", "dpkg", "rpm"}
+    INSTALL_ARGS = re.compile(r"^(install|reinstall|add|upgrade|dist-upgrade|full-upgrade|-S\w*|-i|-U\w*|--install)$")
+    FORK_BOMB = re.compile(r":\s*\(\s*\)\s*\{[^}]*:\s*\|\s*:")
+
+    RULES = {
+        "rm": [
+            CommandRule(RiskLevel.CRITICAL, "recursive delete of a system path", [RECURSIVE], target=SYSTEM_PATH),
+            CommandRule(RiskLevel.CRITICAL, "rm with --no-preserve-root", [("--no-preserve-root",)]),
+            CommandRule(RiskLevel.HIGH, "recursive forced delete", [RECURSIVE, ("f", "--force")]),
+            CommandRule(RiskLevel.MEDIUM, "recursive delete", [RECURSIVE]),
+            CommandRule(RiskLevel.LOW, "deletes files"),
+        ],
+        "dd": [
+            CommandRule(RiskLevel.CRITICAL, "writes to a block device", args=r"^of=/dev/(?!null$|zero$|stdout$|stderr$)"),
+            CommandRule(RiskLevel.LOW, "raw data copy"),
+        ],
+        "mkfs": [CommandRule(RiskLevel.CRITICAL, "creates a filesystem")],
+        "mke2fs": [CommandRule(RiskLevel.CRITICAL, "creates a filesystem")],
+        "mkswap": [CommandRule(RiskLevel.CRITICAL, "formats swap")],
+        "wipefs": [CommandRule(RiskLevel.CRITICAL, "wipes filesystem signatures")],
+        "shred": [CommandRule(RiskLevel.HIGH, "irrecoverably overwrites files")],
+        "fdisk": [CommandRule(RiskLevel.HIGH, "edits a partition table", target=r"^/dev/"),
+                  CommandRule(RiskLevel.LOW, "partition tool")],
+        "sfdisk": [CommandRule(RiskLevel.HIGH, "edits a partition table")],
+        "gdisk": [CommandRule(RiskLevel.HIGH, "edits a partition table")],
+        "cfdisk": [CommandRule(RiskLevel.HIGH, "edits a partition table")],
+        "parted": [CommandRule(RiskLevel.HIGH, "edits a partition table")],
+        "chmod": [
+            CommandRule(RiskLevel.CRITICAL, "recursive permission change on a system path", [RECURSIVE], target=SYSTEM_PATH),
+            CommandRule(RiskLevel.HIGH, "world-writable permissions", args=r"^(0?777|a\+rwx|[ugoa]*\+[rx]*w[rx]*)$"),
+            CommandRule(RiskLevel.MEDIUM, "recursive permission change", [RECURSIVE]),
+        ],
+        "chown": [
+            CommandRule(RiskLevel.CRITICAL, "recursive ownership change on a system path", [RECURSIVE], target=SYSTEM_PATH),
+            CommandRule(RiskLevel.MEDIUM, "recursive ownership change", [RECURSIVE]),
+        ],
+        "mv": [
+            CommandRule(RiskLevel.HIGH, "moves a system path", target=SYSTEM_PATH),
+            CommandRule(RiskLevel.HIGH, "moves files to /dev/null", target=r"^/dev/null$"),
+            CommandRule(RiskLevel.LOW, "moves files"),
+        ],
+        "find": [
+            CommandRule(RiskLevel.HIGH, "find -delete on a system path", target=SYSTEM_PATH, args=r"^-delete$"),
+            CommandRule(RiskLevel.MEDIUM, "find -delete", args=r"^-delete$"),
+        ],
+        "truncate": [CommandRule(RiskLevel.MEDIUM, "truncates files")],
+        "shutdown": [CommandRule(RiskLevel.HIGH, "shuts the system down")],
+        "reboot": [CommandRule(RiskLevel.HIGH, "reboots the system")],
+        "halt": [CommandRule(RiskLevel.HIGH, "halts the system")],
+        "poweroff": [CommandRule(RiskLevel.HIGH, "powers the system off")],
+        "init": [CommandRule(RiskLevel.HIGH, "changes runlevel", args=r"^[06]$")],
+        "systemctl": [CommandRule(RiskLevel.HIGH, "changes system power state", args=r"^(poweroff|reboot|halt|kexec|rescue|emergency)$")],
+        "kill": [CommandRule(RiskLevel.HIGH, "signals every process", target=r"^-1$")],
+        "killall": [CommandRule(RiskLevel.MEDIUM, "kills processes by name")],
+        "pkill": [CommandRule(RiskLevel.MEDIUM, "kills processes by pattern")],
+        "crontab": [CommandRule(RiskLevel.HIGH, "removes the crontab", [("r",)])],
+        "iptables": [CommandRule(RiskLevel.MEDIUM, "flushes firewall rules", [("F", "--flush")])],
+        "ip6tables": [CommandRule(RiskLevel.MEDIUM, "flushes firewall rules", [("F", "--flush")])],
+        "nft": [CommandRule(RiskLevel.MEDIUM, "flushes firewall rules", args=r"^flush$")],
+        "userdel": [CommandRule(RiskLevel.MEDIUM, "deletes a user")],
+    }
+
+    def classify(self, command: str) -> CommandRisk:
+        return self._classify(command, 0)
+
+    @lru_cache(maxsize=1024)
+    def _classify(self, command: str, depth: int) -> CommandRisk:
+        risk = CommandRisk()
+        if self.FORK_BOMB.search(command):
+            risk.add(RiskLevel.CRITICAL, "fork bomb")
+        previous = None
+        for argv, redirects, piped in self._simple_commands(command):
+            for target in redirects:
+                if re.match(self.BLOCK_DEVICE, target):
+                    risk.add(RiskLevel.CRITICAL, f"redirects output to {target}")
+                elif re.match(r"^/(etc|boot)/", target):
+                    risk.add(RiskLevel.HIGH, f"overwrites {target}")
+            program, args = self._unwrap(argv)
+            if program is None:
+                previous = None
+                continue
+            if program == "eval" and args and depth < 3:
+                self._add_inner(risk, " ".join(args), depth)
+            elif program == "su" and depth < 3:
+                inner = self._su_command(args)
+                if inner:
+                    self._add_inner(risk, inner, depth)
+            elif program == "find" and depth < 3:
+                for inner in self._find_commands(args):
+                    self._add_inner(risk, inner, depth)
+            elif program in self.SHELLS:
+                if "-c" in args and args.index("-c") + 1 < len(args) and depth < 3:
+                    self._add_inner(risk, args[args.index("-c") + 1], depth)
+                elif piped and previous in ("curl", "wget"):
+                    risk.add(RiskLevel.HIGH, f"pipes a download from {previous} into {program}")
+            self._apply_rules(program, args, risk)
+            previous = program
+        return risk
+
+    @staticmethod
+    def _su_command(args: List[str]) -> Optional[str]:
+        """The command string of `su -c CMD` / `su --command=CMD`, if any"""
+        for i, arg in enumerate(args):
+            if arg in ("-c", "--command") and i + 1 < len(args):
+                return args[i + 1]
+            if arg.startswith("--command="):
+                return arg.split("=", 1)[1]
+            if arg.startswith("-c") and len(arg) > 2:
+                return arg[2:]
+        return None
+
+    def _find_commands(self, args: List[str]) -> List[str]:
+        """Commands run by find's -exec/-ok actions, with {} replaced by each starting path"""
+        paths = []
+        for arg in args:
+            if arg.startswith(("-", "(", "!")):
+                break
+            paths.append(arg)
+        commands = []
+        for i, arg in enumerate(args):
+            if arg not in self.FIND_EXEC:
+                continue
+            words = []
+            for word in args[i + 1:]:
+                if word in (";", "+"):
+                    break
+                words.append(word)
+            for path in paths or ["."]:
+                commands.append(" ".join(shlex.quote(w.replace("{}", path)) for w in words))
+        return commands
+
+    def _add_inner(self, risk: CommandRisk, command: str, depth: int):
+        """Fold the risk of a command string run by `sh -c` or eval into risk"""
+        inner = self._classify(command, depth + 1)
+        for reason in inner.reasons or ["shell -c"]:
+            risk.add(inner.level, reason)
+
+    def _apply_rules(self, program: str, args: List[str], risk: CommandRisk):
+        rules = self.RULES.get(program) or self.RULES.get(program.split(".")[0])
+        if not rules:
+            return
+        options, operands = set(), []
+        end_of_options = False
+        for arg in args:
+            if end_of_options or not arg.startswith("-") or arg == "-":
+                operands.append(arg)
+            elif arg == "--":
+                end_of_options = True
+            elif arg.startswith("--"):
+                options.add(arg.split("=", 1)[0])
+            else:
+                options.update(arg[1:])
+                if arg[1:].isdigit():
+                    operands.append(arg)
+        for rule in rules:
+            if rule.matches(options, operands, args):
+                risk.add(rule.level, f"{program}: {rule.reason}")
+                return
+
+    def _unwrap(self, argv: List[str]):
+        """Skip assignments and wrapper commands; return (program basename, args)"""
+        i = 0
+        while i < len(argv):
+            word = argv[i]
+            if re.match(r"^[A-Za-z_][A-Za-z0-9_]*=", word) or word in self.KEYWORDS:
+                i += 1
+                continue
+            if word in self.HEADERS:
+                return None, []
+            name = os.path.basename(word)
+            if name not in self.WRAPPERS:
+                return name, argv[i + 1:]
+            short, long = self.WRAPPERS[name]
+            i += 1
+            # A lone "-" is env's short form of -i; elsewhere it is an operand
+            while i < len(argv) and argv[i].startswith("-") and (argv[i] != "-" or name == "env"):
+                option = argv[i]
+                i += 1
+                if option == "--":
+                    break
+                if option.startswith("--"):
+                    value = option.split("=", 1)[1] if "=" in option else None
+                    if option in long and i < len(argv):
+                        value, i = argv[i], i + 1
+                    if name == "env" and option.split("=", 1)[0] == "--split-string" and value is not None:
+                        return self._unwrap(self._split(value) + argv[i:])
+                    continue
+                # A short cluster such as -nu root: the first letter taking a value ends it
+                for position, letter in enumerate(option[1:], 2):
+                    if letter in short:
+                        value = option[position:]
+                        if not value and i < len(argv):
+                            value, i = argv[i], i + 1
+                        if name == "env" and letter == "S":
+                            return self._unwrap(self._split(value) + argv[i:])
+                        break
+            # env VAR=value assignments before the command
+            while name == "env" and i < len(argv) and re.match(r"^[A-Za-z_][A-Za-z0-9_]*=", argv[i]):
+                i += 1
+            if name in self.WRAPPER_OPERAND and i < len(argv):
+                i += 1
+        return None, []
+
+    def escalates(self, command: str) -> bool:
+        """Whether the command line runs anything as another user or installs software"""
+        for argv, _, _ in self._simple_commands(command):
+            program, args = self._unwrap(argv)
+            wrappers = argv[:len(argv) - len(args)]
+            if any(os.path.basename(word) in self.ESCALATORS for word in wrappers):
+                return True
+            if program in self.PACKAGE_MANAGERS and any(self.INSTALL_ARGS.match(arg) for arg in args):
+                return True
+        return False
+
+    @staticmethod
+    def _split(text: str) -> List[str]:
+        try:
+            return shlex.split(text)
+        except ValueError:
+            return text.split()
+
+    def programs(self, command: str) -> List:
+        """(program, args) for each simple command in the line, with wrappers skipped"""
+        programs = []
+        for argv, _, _ in self._simple_commands(command):
+            program, args = self._unwrap(argv)
+            if program is not None:
+                programs.append((program, args))
+        return programs
+
+    def _simple_commands(self, command: str):
+        """Yield (argv, redirect targets, piped-from-previous) for each simple command"""
+        try:
+            lexer = shlex.shlex(command.replace("\n", " ; ").replace("`", " ` "), posix=True, punctuation_chars=True)
+            lexer.whitespace_split = True
+            tokens = list(lexer)
+        except ValueError:
+            tokens = re.findall(r"[|;&()<>]+|[^\s|;&()<>]+", command)
+        argv, redirects, piped = [], [], False
+        expect_target = False
+        for token in tokens:
+            if expect_target:
+                redirects.append(token)
+                expect_target = False
+            elif token in self.SEPARATORS:
+                if argv or redirects:
+                    yield argv, redirects, piped
+                argv, redirects = [], []
+                piped = token in ("|", "|&")
+            elif set(token) <= set("<>&|") and ">" in token:
+                if argv and argv[-1].isdigit():
+                    argv.pop()
+                expect_target = True
+            elif set(token) <= set("<>&|"):
+                expect_target = token.startswith("<")
+            else:
+                argv.append(token)
+        if argv or redirects:
+            yield argv, redirects, piped
+
+class OutputBuffer:
+    """Ring buffer that keeps only the last `limit` characters of a stream"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.truncated = False
+        self.received = 0
+        self._chunks = deque()
+        self._size = 0
+
+    def append(self, text: str):
+        self.received += len(text.encode())
+        self._chunks.append(text)
+        self._size += len(text)
+        while self._size > self.limit:
+            # Drop whole chunks while they fit in the excess, then trim the oldest one
+            excess = self._size - self.limit
+            if len(self._chunks[0]) <= excess:
+                self._size -= len(self._chunks.popleft())
+            else:
+                self._chunks[0] = self._chunks[0][excess:]
+                self._size -= excess
+            self.truncated = True
+
+    def getvalue(self) -> str:
+        text = "".join(self._chunks)
+        if len(text) > self.limit:
+            self.truncated = True
+            text = text[-self.limit:]
+        return text
+
+class CommandResult:
+    """Exit status and retained output of a finished command"""
+    __slots__ = ("command", "exit_code", "stdout", "stderr", "duration", "timed_out", "interrupted",
+                 "truncated", "output_bytes")
+
+    def __init__(self, command: str, exit_code: int, stdout: str = "", stderr: str = "",
+                 duration: float = 0.0, timed_out: bool = False, interrupted: bool = False,
+                 truncated: bool = False, output_bytes: int = 0):
+        self.command = command
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.timed_out = timed_out
+        self.interrupted = interrupted
+        self.truncated = truncated
+        self.output_bytes = output_bytes
+
+    @property
+    def failed(self) -> bool:
+        return self.exit_code != 0 and not self.interrupted
+
+# Popen arguments that put the child in its own process group without leaving the terminal's session
+OWN_PROCESS_GROUP = {"process_group": 0} if sys.version_info >= (3, 11) else {"preexec_fn": os.setpgrp}
+
+class ForegroundTerminal:
+    """Lends the controlling terminal to a child process group while it runs.
+
+    The child can then open /dev/tty for sudo, ssh or git password prompts,
+    and Ctrl-C reaches it rather than the assistant.
+    """
+
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    @classmethod
+    def attach(cls) -> Optional['ForegroundTerminal']:
+        """The terminal on stdin, or None when there is none to lend"""
+        try:
+            return cls(sys.stdin.fileno()) if sys.stdin.isatty() else None
+        except (AttributeError, ValueError, OSError):
+            return None
+
+    @contextmanager
+    def lend(self, pgid: int):
+        try:
+            owned = os.tcgetpgrp(self.fd) == os.getpgrp()
+        except OSError:
+            owned = False
+        if not owned:
+            yield
+            return
+        os.tcsetpgrp(self.fd, pgid)
+        try:
+            # Resume the child if it touched the terminal before the hand-over and was stopped
+            os.killpg(pgid, signal.SIGCONT)
+        except OSError:
+            pass
+        try:
+            yield
+        finally:
+            # Taking the terminal back from the background would otherwise raise SIGTTOU
+            blocked = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTTOU})
+            try:
+                os.tcsetpgrp(self.fd, os.getpgrp())
+            except OSError:
+                pass
+            finally:
+                signal.pthread_sigmask(signal.SIG_SETMASK, blocked)
+
+class StreamingExecutor:
+    """Run shell commands, handing output to a callback line by line as it arrives.
+
+    Only the last `buffer_limit` characters of each stream are retained, so
+    long-running or very chatty commands do not grow memory without bound.
+    """
+
+    READ_SIZE = 65536
+
+    def __init__(self, buffer_limit: int = 64 * 1024, shell: str = "bash"):
+        self.buffer_limit = buffer_limit
+        self.shell = shell
+        self._active = set()
+        self._interrupted = set()
+        self._active_lock = threading.Lock()
+
+    def run(self, command: str, cwd: Optional[str] = None,
+            on_output: Optional[Callable[[str, str], None]] = None,
+            timeout: Optional[float] = None, env: Optional[Dict[str, str]] = None) -> CommandResult:
+        start = time.monotonic()
+        process = subprocess.Popen(
+            [self.shell, "-c", command],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,
+            env=env,
+            # Own session: several of these may run at once, so none can own the terminal
+            start_new_session=True,
+        )
+        with self._active_lock:
+            self._active.add(process)
+        buffers = {"stdout": OutputBuffer(self.buffer_limit), "stderr": OutputBuffer(self.buffer_limit)}
+        timed_out = interrupted = False
+        try:
+            timed_out = not self._pump(process, buffers, on_output, timeout and start + timeout)
+        except KeyboardInterrupt:
+            interrupted = True
+        finally:
+            with self._active_lock:
+                self._active.discard(process)
+                interrupted = process in self._interrupted or interrupted
+                self._interrupted.discard(process)
+        if timed_out or interrupted:
+            self._kill(process)
+        exit_code = 130 if interrupted else process.wait()
+        stderr = buffers["stderr"].getvalue()
+        if timed_out:
+            stderr += f"Error: command timed out after {timeout} seconds\n"
+        return CommandResult(
+            command, exit_code, buffers["stdout"].getvalue(), stderr,
+            duration=time.monotonic() - start, timed_out=timed_out, interrupted=interrupted,
+            truncated=buffers["stdout"].truncated or buffers["stderr"].truncated,
+            output_bytes=buffers["stdout"].received + buffers["stderr"].received,
+        )
+
+    def _pump(self, process, buffers, on_output, deadline, marker: Optional[str] = None,
+              framing: Optional[Dict[str, str]] = None) -> bool:
+        """Forward output until both pipes close; False if the deadline passed first.
+
+        With a marker, a stream also ends at the first line containing it and
+        the text after the marker is stored in framing[stream] instead of being
+        forwarded.
+        """
+        selector = selectors.DefaultSelector()
+        for name in ("stdout", "stderr"):
+            stream = getattr(process, name)
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            selector.register(stream, selectors.EVENT_READ, [name, decoder, ""])
+        try:
+            while selector.get_map():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                for key, _ in selector.select(remaining):
+                    name, decoder, partial = key.data
+                    data = os.read(key.fd, self.READ_SIZE)
+                    text = partial + decoder.decode(data, final=not data)
+                    lines = text.splitlines(keepends=True)
+                    partial = lines.pop() if lines and data and not lines[-1].endswith(("\n", "\r")) else ""
+                    if len(partial) > self.READ_SIZE and not (marker and marker in partial):
+                        # Output without newlines (minified or binary files) is passed on in pieces;
+                        # the tail that could be the start of a marker is held back
+                        keep = len(marker) - 1 if marker else 0
+                        lines.append(partial[:len(partial) - keep])
+                        partial = partial[len(partial) - keep:]
+                    key.data[2] = partial
+                    for line in lines:
+                        if marker and marker in line:
+                            line, framing[name] = line.split(marker, 1)
+                        if line:
+                            buffers[name].append(line)
+                            if on_output:
+                                on_output(name, line)
+                        if name in (framing or ()):
+                            break
+                    if name in (framing or ()):
+                        selector.unregister(key.fileobj)
+                    elif not data:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+            return True
+        finally:
+            selector.close()
+
+    def interrupt(self):
+        """Kill every command this executor is running, e.g. on Ctrl-C in another thread"""
+        with self._active_lock:
+            processes = list(self._active)
+            self._interrupted.update(processes)
+        for process in processes:
+            self._kill(process)
+
+    def _kill(self, process):
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(process.pid, sig)
+                process.wait(timeout=2)
+                return
+            except (ProcessLookupError, PermissionError):
+                return
+            except subprocess.TimeoutExpired:
+                continue
+
+class ShellSession(StreamingExecutor):
+    """Long-lived bash process that keeps cwd, variables and aliases between commands.
+
+    Each command is run through `eval` and followed by sentinel lines on
+    stdout and stderr carrying its exit status and the shell's working
+    directory, so output is framed without waiting for EOF. A timeout kills
+    the shell's process group; the next command starts a fresh shell in the
+    last known directory.
+
+    Given a terminal, the shell stays in the terminal's session in its own
+    process group and is made the foreground group for each command, which
+    reads stdin from /dev/tty. Ctrl-C then interrupts only the command and
+    the shell survives. Without one the shell runs detached in a new session.
+    """
+
+    def __init__(self, cwd: Optional[str] = None, buffer_limit: int = 64 * 1024,
+                 terminal: Optional[ForegroundTerminal] = None):
+        super().__init__(buffer_limit)
+        self.cwd = cwd or os.getcwd()
+        self.terminal = terminal
+        self.process = None
+        self._marker = f"__ASSISTANT_{os.urandom(8).hex()}__"
+        self._lock = threading.Lock()
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            ["bash", "--noprofile", "--norc"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=self.cwd,
+            **(OWN_PROCESS_GROUP if self.terminal else {"start_new_session": True}),
+        )
+        # A trap (unlike ignoring INT) still lets Ctrl-C kill the command but keeps the shell
+        self._send("shopt -s expand_aliases\n" + ("trap : INT\n" if self.terminal else ""))
+
+    def close(self):
+        if self.alive:
+            try:
+                self._send("exit\n")
+                self.process.wait(timeout=2)
+            except (OSError, subprocess.TimeoutExpired):
+                self._kill(self.process)
+        self.process = None
+
+    def _send(self, text: str):
+        self.process.stdin.write(text.encode())
+        self.process.stdin.flush()
+
+    def environment(self) -> Dict[str, str]:
+        """The session's exported variables, for commands run outside it"""
+        result = self.run("env -0")
+        if result.exit_code != 0 or result.truncated:
+            return dict(os.environ)
+        return dict(entry.split("=", 1) for entry in result.stdout.split("\0") if "=" in entry)
+
+    def run(self, command: str, cwd: Optional[str] = None,
+            on_output: Optional[Callable[[str, str], None]] = None,
+            timeout: Optional[float] = None) -> CommandResult:
+        with self._lock:
+            if not self.alive:
+                self.start()
+            start = time.monotonic()
+            if cwd and cwd != self.cwd:
+                command = f"cd {shlex.quote(cwd)} && {command}"
+            self._send(
+                f"eval {shlex.quote(command)} <{'/dev/tty' if self.terminal else '/dev/null'}\n"
+                f"__assistant_rc=$?; printf '%s %d %s\\n' {self._marker} \"$__assistant_rc\" \"$PWD\"; "
+                f"printf '%s\\n' {self._marker} >&2\n"
+            )
+            buffers = {"stdout": OutputBuffer(self.buffer_limit), "stderr": OutputBuffer(self.buffer_limit)}
+            framing = {}
+            timed_out = interrupted = False
+            try:
+                with self.terminal.lend(self.process.pid) if self.terminal else nullcontext():
+                    timed_out = not self._pump(self.process, buffers, on_output,
+                                               timeout and start + timeout, self._marker, framing)
+            except KeyboardInterrupt:
+                interrupted = True
+            if timed_out or interrupted:
+                self._kill(self.process)
+                self.process = None
+                exit_code = 130 if interrupted else -signal.SIGTERM
+            elif "stdout" in framing:
+                status, _, cwd = framing["stdout"].strip().partition(" ")
+                exit_code = int(status)
+                self.cwd = cwd or self.cwd
+                interrupted = self.terminal is not None and exit_code == 128 + signal.SIGINT
+            else:
+                # The command ended the shell itself (e.g. `exit`)
+                exit_code = self.process.wait()
+                self.process = None
+            stderr = buffers["stderr"].getvalue()
+            if timed_out:
+                stderr += f"Error: command timed out after {timeout} seconds\n"
+            return CommandResult(
+                command, exit_code, buffers["stdout"].getvalue(), stderr,
+                duration=time.monotonic() - start, timed_out=timed_out, interrupted=interrupted,
+                truncated=buffers["stdout"].truncated or buffers["stderr"].truncated,
+                output_bytes=buffers["stdout"].received + buffers["stderr"].received,
+            )
+
+class Diagnosis:
+    """Locally recognized cause of a failed command.
+
+    fix is a command expected to remedy it; check only gathers more
+    information (free space, the parent directory) and never counts as a
+    recovery.
+    """
+    __slots__ = ("rule", "cause", "fix", "check")
+
+    def __init__(self, rule: str, cause: str, fix: Optional[str] = None, check: Optional[str] = None):
+        self.rule = rule
+        self.cause = cause
+        self.fix = fix
+        self.check = check
+
+class ErrorTriage:
+    """Explain common command failures offline before involving the model.
+
+    Only failed commands are triaged, judged by exit code with stderr kept
+    apart from stdout, so successful output that mentions "error" never
+    costs a request. RULES is a precompiled table tried in order against
+    stderr; the first match is passed to the _<rule> handler, which returns
+    a Diagnosis or None. Unknown failures are escalated with excerpt(), a
+    compact extract of the lines that look like errors.
+    """
+
+    RULES = tuple((name, re.compile(pattern, re.IGNORECASE | re.MULTILINE), exit_codes) for name, pattern, exit_codes in (
+        ("command_not_found", r"^(?:.*?: )?(?:line \d+: )?([^\s:]+): (?:command )?not found$", (127,)),
+        ("permission_denied", r"Permission denied|Operation not permitted|are you root\?|must be (?:run as )?root", None),
+        ("missing_file", r"cannot (?:access|stat|open) '([^']+)'|^(?:.*?: )?([^\s:]+): No such file or directory", None),
+        ("port_in_use", r"^.*(?:Address already in use|EADDRINUSE|port \d+ is already (?:in use|allocated)).*$", None),
+        ("disk_full", r"No space left on device|Disk quota exceeded", None),
+        ("package_lock", r"Could not get lock (\S+)|Waiting for cache lock|another process is using the packag", None),
+        ("dns_failure", r"Could not resolve host:? ([^\s;,]+)|Temporary failure in name resolution|Name or service not known", None),
+    ))
+    LOOKS_LIKE_ERROR = re.compile(
+        r"error|fatal|fail|denied|not found|no such|cannot|can't|unable|invalid|refused|exception|traceback|usage:",
+        re.IGNORECASE)
+    # command -> (apt package, rpm package) for tools often missing from minimal installs
+    PACKAGES = {
+        "netstat": ("net-tools", "net-tools"), "ifconfig": ("net-tools", "net-tools"),
+        "route": ("net-tools", "net-tools"), "arp": ("net-tools", "net-tools"),
+        "dig": ("dnsutils", "bind-utils"), "nslookup": ("dnsutils", "bind-utils"), "host": ("dnsutils", "bind-utils"),
+        "ip": ("iproute2", "iproute"), "ss": ("iproute2", "iproute"),
+        "ping": ("iputils-ping", "iputils"), "traceroute": ("traceroute", "traceroute"),
+        "nc": ("netcat-openbsd", "nmap-ncat"), "telnet": ("telnet", "telnet"),
+        "killall": ("psmisc", "psmisc"), "pstree": ("psmisc", "psmisc"), "fuser": ("psmisc", "psmisc"),
+        "lspci": ("pciutils", "pciutils"), "lsusb": ("usbutils", "usbutils"),
+        "iostat": ("sysstat", "sysstat"), "sar": ("sysstat", "sysstat"), "mpstat": ("sysstat", "sysstat"),
+        "pip": ("python3-pip", "python3-pip"), "pip3": ("python3-pip", "python3-pip"),
+        "python": ("python3", "python3"), "ab": ("apache2-utils", "httpd-tools"),
+        "htpasswd": ("apache2-utils", "httpd-tools"), "mkfs.xfs": ("xfsprogs", "xfsprogs"),
+        "docker": ("docker.io", "docker"), "7z": ("p7zip-full", "p7zip"),
+    }
+    # Installed under their own name by both families
+    SAME_NAME = {"curl", "wget", "git", "jq", "unzip", "zip", "rsync", "tree", "htop", "vim", "make", "gcc",
+                 "tmux", "strace", "lsof", "nmap", "tcpdump", "screen", "bc", "file", "less", "whois", "sqlite3"}
+    COMMAND_NOT_FOUND_HELPER = "/usr/lib/command-not-found"
+
+    def diagnose(self, result: CommandResult, package_manager: str = "apt") -> Optional[Diagnosis]:
+        if not result.failed:
+            return None
+        if result.timed_out:
+            return Diagnosis("timeout", "the command hit the time limit (change it with `set timeout`)")
+        text = result.stderr or result.stdout
+        for name, pattern, exit_codes in self.RULES:
+            if exit_codes and result.exit_code not in exit_codes:
+                continue
+            match = pattern.search(text)
+            if match:
+                diagnosis = getattr(self, f"_{name}")(match, result, package_manager)
+                if diagnosis is not None:
+                    return diagnosis
+        return None
+
+    def matches(self, text: str) -> bool:
+        """Whether partial stderr already matches a local rule"""
+        return any(pattern.search(text) for _, pattern, _ in self.RULES)
+
+    def excerpt(self, result: CommandResult, max_lines: int = 15, max_chars: int = 1500) -> str:
+        """The error-looking lines of a failure plus its last lines, for the model"""
+        lines = (result.stderr or result.stdout).rstrip("\n").splitlines()
+        keep = {i for i, line in enumerate(lines) if self.LOOKS_LIKE_ERROR.search(line)}
+        keep.update(range(max(0, len(lines) - 3), len(lines)))
+        picked, seen = [], set()
+        for i in sorted(keep):
+            line = lines[i].strip()
+            if line and line not in seen:
+                seen.add(line)
+                picked.append(line)
+        return ContextBuilder.summarize_output("\n".join(picked[-max_lines:]), max_chars)
+
+    def find_package(self, program: str, package_manager: str) -> Optional[str]:
+        if program in self.PACKAGES:
+            return self.PACKAGES[program][0 if package_manager == "apt" else 1]
+        if program in self.SAME_NAME:
+            return program
+        if package_manager == "apt" and os.path.exists(self.COMMAND_NOT_FOUND_HELPER):
+            try:
+                helper = subprocess.run([self.COMMAND_NOT_FOUND_HELPER, "--no-failure-msg", program],
+                                        capture_output=True, text=True, timeout=3)
+                match = re.search(r"apt install (\S+)", helper.stdout + helper.stderr)
+                if match:
+                    return match.group(1)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        return None
+
+    def _command_not_found(self, match, result: CommandResult, package_manager: str) -> Optional[Diagnosis]:
+        program = match.group(1)
+        package = self.find_package(os.path.basename(program), package_manager)
+        if package is None:
+            # Possibly a typo; the model is better at that
+            return None
+        install = "sudo apt install -y" if package_manager == "apt" else "sudo dnf install -y"
+        return Diagnosis("command_not_found", f"{program} is not installed (package {package})",
+                         f"{install} {package}")
+
+    def _permission_denied(self, match, result: CommandResult, package_manager: str) -> Diagnosis:
+        command = result.command.strip()
+        if result.exit_code == 126:
+            program = command.split()[0] if command.split() else command
+            return Diagnosis("permission_denied", f"{program} is not executable", f"chmod +x {shlex.quote(program)}")
+        if command.startswith("sudo "):
+            return Diagnosis("permission_denied",
+                             "denied even as root: check read-only mounts, immutable files (lsattr) or SELinux/AppArmor")
+        return Diagnosis("permission_denied", "the command needs more privileges than the current user has",
+                         f"sudo {command}")
+
+    def _missing_file(self, match, result: CommandResult, package_manager: str) -> Diagnosis:
+        path = match.group(1) or match.group(2)
+        parent = os.path.dirname(path.rstrip("/")) or "."
+        return Diagnosis("missing_file", f"{path} does not exist",
+                         check=f"ls -la {shlex.quote(parent)}")
+
+    def _port_in_use(self, match, result: CommandResult, package_manager: str) -> Diagnosis:
+        port = re.search(r"(?:port |:)(\d{2,5})\b", match.group(0)) or \
+            re.search(r"(?:-p\s*|--port[= ]|:)(\d{2,5})\b", result.command)
+        if port:
+            return Diagnosis("port_in_use", f"port {port.group(1)} is already taken by another process",
+                             check=f"sudo ss -ltnp 'sport = :{port.group(1)}'")
+        return Diagnosis("port_in_use", "the address is already taken by another process",
+                         check="sudo ss -ltnp")
+
+    def _disk_full(self, match, result: CommandResult, package_manager: str) -> Diagnosis:
+        return Diagnosis("disk_full", "the filesystem (or quota) is full", check="df -h")
+
+    def _package_lock(self, match, result: CommandResult, package_manager: str) -> Diagnosis:
+        return Diagnosis("package_lock", "another package manager process holds the lock; wait for it to finish",
+                         check="ps aux | grep -E '[a]pt|[d]pkg|[d]nf|[y]um'")
+
+    def _dns_failure(self, match, result: CommandResult, package_manager: str) -> Diagnosis:
+        host = match.group(1)
+        if host:
+            return Diagnosis("dns_failure", f"{host} could not be resolved", check=f"getent hosts {shlex.quote(host)}")
+        return Diagnosis("dns_failure", "name resolution failed", check="cat /etc/resolv.conf")
+
+class ContextBuilder:
+    """Assemble prompt context within an approximate token budget.
+
+    Tokens are estimated at four characters each. System facts are
+    serialized compactly and memoized until a value changes. History gets
+    the rest of the budget, with the latest command and failures served
+    first; long outputs are cut to head and tail and repeated lines are
+    collapsed.
+    """
+
+    CHARS_PER_TOKEN = 4
+
+    def __init__(self, budget: int = 2000, system_share: float = 0.35, history_window: int = 20):
+        self.budget = budget
+        self.system_share = system_share
+        self.history_window = history_window
+        self._system_memo = (None, "")
+
+    @classmethod
+    def estimate_tokens(cls, text: str) -> int:
+        return -(-len(text) // cls.CHARS_PER_TOKEN)
+
+    @staticmethod
+    def summarize_output(text: str, max_chars: int) -> str:
+        """Collapse runs of identical lines, then keep head and tail if still too long"""
+        lines, previous, repeats = [], None, 0
+        for line in text.rstrip("\n").splitlines():
+            if line == previous:
+                repeats += 1
+                continue
+            if repeats:
+                lines.append(f"[previous line repeated {repeats} more times]")
+            lines.append(line)
+            previous, repeats = line, 0
+        if repeats:
+            lines.append(f"[previous line repeated {repeats} more times]")
+        text = "\n".join(lines)
+        if len(text) <= max_chars:
+            return text
+        if max_chars < 40:
+            return text[:max_chars]
+        keep = max_chars - len(f"\n[... {len(text)} characters omitted ...]\n")
+        head = text[:keep * 2 // 5]
+        tail = text[len(text) - (keep - len(head)):]
+        # Prefer cutting on line boundaries when that doesn't discard everything
+        head = head[:head.rfind("\n")] if "\n" in head else head
+        tail = tail[tail.find("\n") + 1:] if "\n" in tail[:-1] else tail
+        return f"{head}\n[... {len(text) - len(head) - len(tail)} characters omitted ...]\n{tail}"
+
+    def system_section(self, facts: Dict) -> str:
+        """Compact JSON of the system facts, each string trimmed to a fair share of the budget"""
+        key = tuple(facts.items())
+        if self._system_memo[0] == key:
+            return self._system_memo[1]
+        limit = int(self.budget * self.system_share) * self.CHARS_PER_TOKEN
+        strings = [k for k, v in facts.items() if isinstance(v, str)]
+        share = max(40, limit // max(1, len(strings)))
+        # Let short fields donate their unused share to long ones
+        spare = sum(share - len(facts[k]) for k in strings if len(facts[k]) < share)
+        long_fields = [k for k in strings if len(facts[k]) >= share]
+        if long_fields:
+            share += spare // len(long_fields)
+        compact = {k: self.summarize_output(v, share) if isinstance(v, str) else v for k, v in facts.items()}
+        text = json.dumps(compact, separators=(",", ":"))
+        self._system_memo = (key, text)
+        return text
+
+    def history_section(self, history: List["HistoryEntry"], budget: Optional[int] = None) -> str:
+        """Recent commands in chronological order, most relevant first within the budget"""
+        entries = list(history[-self.history_window:])
+        if not entries:
+            return ""
+        remaining = (budget if budget is not None else self.budget - self.estimate_tokens(self._system_memo[1])) * self.CHARS_PER_TOKEN
+        latest = len(entries) - 1
+        order = [latest] + [i for i in range(latest - 1, -1, -1) if not entries[i].success] \
+            + [i for i in range(latest - 1, -1, -1) if entries[i].success]
+        rendered = {}
+        for rank, i in enumerate(order):
+            entry = entries[i]
+            header = f"Command: {entry.command}\nSuccess: {entry.success}\nOutput: "
+            if remaining < len(header) + 20:
+                break
+            # The latest output may use half of what is left, the others a quarter
+            allowance = remaining // 2 if rank == 0 else remaining // 4
+            output = self.summarize_output(entry.output, max(20, allowance - len(header)))
+            rendered[i] = header + output
+            remaining -= len(rendered[i]) + 1
+        return "\n".join(rendered[i] for i in sorted(rendered))
+
+class ConversationMemory:
+    """Chat history within an approximate token budget.
+
+    Recent turns are kept verbatim. Once they outgrow their share of the
+    budget, the oldest are handed to summarize(previous_summary, turns),
+    which returns a Future, and are folded into a running summary in the
+    background. They are still sent verbatim until that summary arrives, so
+    a turn never waits on it. If summarizing fails, the user's questions
+    from those turns are kept as a crude summary instead.
+    """
+
+    def __init__(self, summarize: Callable[[str, List[Dict]], Future], budget: int = 3000,
+                 summary_share: float = 0.25, min_turns: int = 2):
+        self.summarize = summarize
+        self.budget = budget
+        self.summary_share = summary_share
+        self.min_turns = min_turns
+        self.summary = ""
+        self.turns = deque()
+        self._folding = []
+        self._pending = None
+        self._lock = threading.Lock()
+
+    @property
+    def summary_chars(self) -> int:
+        return int(self.budget * self.summary_share) * ContextBuilder.CHARS_PER_TOKEN
+
+    @staticmethod
+    def turn_tokens(turn: List[Dict]) -> int:
+        return sum(ContextBuilder.estimate_tokens(m["content"]) for m in turn)
+
+    def add(self, user: str, assistant: str):
+        with self._lock:
+            self.turns.append([{"role": "user", "content": user}, {"role": "assistant", "content": assistant}])
+            if self._pending is not None:
+                return
+            limit = self.budget - ContextBuilder.estimate_tokens(self.summary)
+            total = sum(self.turn_tokens(t) for t in self.turns)
+            while total > limit and len(self.turns) > self.min_turns:
+                turn = self.turns.popleft()
+                total -= self.turn_tokens(turn)
+                self._folding.append(turn)
+            if not self._folding:
+                return
+            messages = [m for turn in self._folding for m in turn]
+            self._pending = self.summarize(self.summary, messages)
+        self._pending.add_done_callback(self._folded)
+
+    def _folded(self, future: Future):
+        with self._lock:
+            try:
+                summary = future.result()
+            except BaseException:
+                questions = [m["content"] for turn in self._folding for m in turn if m["role"] == "user"]
+                summary = "\n".join([self.summary, "Earlier questions: " + "; ".join(questions)]).strip()
+            if len(summary) > self.summary_chars:
+                summary = summary[-self.summary_chars:]
+            self.summary = summary.strip()
+            self._folding = []
+            self._pending = None
+
+    def messages(self, system_prompt: str, user: str) -> List[Dict]:
+        """Messages for the next request: summary, unsummarized turns, then the new question"""
+        with self._lock:
+            system = system_prompt
+            if self.summary:
+                system += f"\n\nSummary of the earlier conversation:\n{self.summary}"
+            history = [m for turn in self._folding + list(self.turns) for m in turn]
+        return [{"role": "system", "content": system}, *history, {"role": "user", "content": user}]
+
+class TaskStep:
+    """One command of a multi-step plan and the 1-based steps it waits for"""
+    __slots__ = ("index", "command", "depends_on", "rollback", "result")
+
+    def __init__(self, index: int, command: str, depends_on: List[int], rollback: str = ""):
+        self.index = index
+        self.command = command
+        self.depends_on = depends_on
+        self.rollback = rollback
+        self.result = None
+
+    @classmethod
+    def from_plan(cls, response: dict) -> List["TaskStep"]:
+        """Build steps from a planner response.
+
+        Commands may be plain strings or objects with "command", "depends_on"
+        and "rollback" keys; a top-level "depends_on" list parallel to
+        "commands" is accepted too. Without any dependency information every
+        step waits for the one before it. Only references to earlier steps are
+        kept, so the graph cannot contain cycles.
+        """
+        commands = response.get("commands") or []
+        graph = response.get("depends_on")
+        rollback = response.get("rollback") or []
+        aligned = len(rollback) == len(commands)
+        has_graph = isinstance(graph, list) or any(isinstance(c, dict) and "depends_on" in c for c in commands)
+        steps = []
+        for i, entry in enumerate(commands, 1):
+            if isinstance(entry, dict):
+                command = str(entry.get("command", ""))
+                deps = entry.get("depends_on", [])
+                undo = entry.get("rollback") or ""
+            else:
+                command = str(entry)
+                deps = graph[i - 1] if isinstance(graph, list) and i <= len(graph) else []
+                undo = ""
+            if not undo and aligned:
+                undo = rollback[i - 1] or ""
+            if not has_graph:
+                deps = [i - 1] if i > 1 else []
+            if not isinstance(deps, list):
+                deps = [deps]
+            deps = sorted({int(d) for d in deps if str(d).isdigit() and 0 < int(d) < i})
+            if command.strip():
+                steps.append(cls(i, command, deps, str(undo)))
+        return steps
+
+class StepScheduler:
+    """Run plan steps as soon as their dependencies succeed, in a bounded pool.
+
+    A failed step stops anything new from being scheduled: steps already
+    running finish, and steps still waiting are skipped. With a single worker
+    steps run inline in the calling thread so Ctrl-C reaches them. Otherwise
+    Ctrl-C calls `cancel` to stop the running steps and ends the run as a
+    failure would.
+    """
+
+    def __init__(self, run_step: Callable[[TaskStep], CommandResult], max_workers: int = 4,
+                 cancel: Optional[Callable[[], None]] = None):
+        self.run_step = run_step
+        self.max_workers = max(1, max_workers)
+        self.cancel = cancel
+
+    def run(self, steps: List[TaskStep]) -> List[TaskStep]:
+        """Execute the plan and return the steps that ran, in completion order"""
+        pending = list(steps)
+        done, ran = set(), []
+        if self.max_workers == 1:
+            for step in pending:
+                if not all(d in done for d in step.depends_on):
+                    continue
+                self._finish(step, self._call(step), ran)
+                if step.result.exit_code != 0:
+                    break
+                done.add(step.index)
+            return ran
+
+        failed = False
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="step") as pool:
+            running = {}
+            while True:
+                if not failed:
+                    for step in [s for s in pending if all(d in done for d in s.depends_on)]:
+                        pending.remove(step)
+                        running[pool.submit(self._call, step)] = step
+                if not running:
+                    break
+                try:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                except KeyboardInterrupt:
+                    failed = True
+                    if self.cancel:
+                        self.cancel()
+                    finished, _ = wait(running)
+                for future in finished:
+                    step = running.pop(future)
+                    self._finish(step, future.result(), ran)
+                    if step.result.exit_code != 0:
+                        failed = True
+                    else:
+                        done.add(step.index)
+        return ran
+
+    def _call(self, step: TaskStep) -> CommandResult:
+        try:
+            return self.run_step(step)
+        except Exception as e:
+            return CommandResult(step.command, -1, stderr=f"Error: {str(e)}\n")
+
+    def _finish(self, step: TaskStep, result: CommandResult, ran: List[TaskStep]):
+        step.result = result
+        ran.append(step)
+
+def connect_private(path: str) -> sqlite3.Connection:
+    """Open a SQLite file readable only by the current user (0600 in a 0700 directory)"""
+    if path != ":memory:":
+        # An existing directory is left alone: it may be shared, e.g. /tmp
+        os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+        try:
+            # Tighten a file left readable by earlier versions, like bash does for its history
+            if os.stat(path).st_mode & 0o077:
+                os.chmod(path, 0o600)
+        except FileNotFoundError:
+            os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+    return sqlite3.connect(path, check_same_thread=False)
+
+class ResponseCache:
+    """On-disk LRU cache of structured AI responses, bounded by size and age.
+
+    Entries are keyed on the model, the whitespace-collapsed prompt and a
+    fingerprint of the context the answer depends on. Hit and miss counters
+    cover the current session only.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = 500,
+                 ttl: float = 7 * 24 * 3600, enabled: bool = True):
+        if path is None:
+            cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+            path = os.path.join(cache_home, "linux-assistant", "responses.sqlite3")
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            self._db = connect_private(self.path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "created REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        return self._db
+
+    @staticmethod
+    def make_key(model: str, prompt: str, context: Dict) -> str:
+        # Whitespace only: case matters in commands, paths and error text
+        normalized = " ".join(prompt.split())
+        fingerprint = json.dumps(context, sort_keys=True, default=str)
+        return hashlib.sha256(f"{model}\0{normalized}\0{fingerprint}".encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        if not self.enabled:
+            return None
+        now = time.time()
+        try:
+            with self._lock:
+                db = self._connect()
+                row = db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row and now - row[1] < self.ttl:
+                    db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+                    db.commit()
+                    self.hits += 1
+                    return json.loads(row[0])
+                if row:
+                    db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    db.commit()
+        except (sqlite3.Error, OSError, ValueError):
+            pass
+        self.misses += 1
+        return None
+
+    def put(self, key: str, response: dict):
+        if not self.enabled:
+            return
+        now = time.time()
+        try:
+            with self._lock:
+                db = self._connect()
+                db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                           (key, json.dumps(response), now, now))
+                db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+                db.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                    "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,)
+                )
+                db.commit()
+        except (sqlite3.Error, OSError):
+            pass
+
+    def clear(self):
+        try:
+            with self._lock:
+                db = self._connect()
+                db.execute("DELETE FROM responses")
+                db.commit()
+        except (sqlite3.Error, OSError):
+            pass
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        try:
+            with self._lock:
+                return self._connect().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        except (sqlite3.Error, OSError):
+            return 0
+
+class HistoryEntry:
+    """A recorded command; large outputs are held zlib-compressed"""
+    __slots__ = ("id", "command", "exit_code", "timestamp", "_output")
+
+    COMPRESS_THRESHOLD = 1024
+
+    def __init__(self, command: str, output, exit_code: int, timestamp: float, id: Optional[int] = None):
+        self.id = id
+        self.command = command
+        self.exit_code = exit_code
+        self.timestamp = timestamp
+        if isinstance(output, str) and len(output) > self.COMPRESS_THRESHOLD:
+            output = zlib.compress(output.encode())
+        self._output = output
+
+    @property
+    def output(self) -> str:
+        return zlib.decompress(self._output).decode() if isinstance(self._output, bytes) else self._output
+
+    @property
+    def stored_output(self):
+        """Output as persisted: a str, or compressed bytes for large outputs"""
+        return self._output
+
+    @property
+    def success(self) -> bool:
+        return self.exit_code == 0
+
+class HistoryStore:
+    """Bounded command history persisted to SQLite across sessions.
+
+    Each output is capped to its head and tail before storing. The current
+    session's most recent entries stay in memory for prompt context. Older
+    sessions are reached through search(), which uses an FTS5 index when
+    SQLite provides one. The table is pruned to `max_stored` rows when it is
+    opened and whenever an insert takes it past that.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = 200,
+                 max_output: int = 16 * 1024, max_stored: int = 5000):
+        if path is None:
+            path = os.environ.get("ASSISTANT_HISTORY_FILE")
+        if path is None:
+            state_home = os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state")
+            path = os.path.join(state_home, "linux-assistant", "history.sqlite3")
+        self.path = path
+        self.max_output = max_output
+        self.max_stored = max_stored
+        self.entries = deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+        self._db = None
+        self._fts = False
+        self._rows = 0
+
+    def _connect(self):
+        if self._db is None:
+            db = connect_private(self.path)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                "id INTEGER PRIMARY KEY, ts REAL NOT NULL, command TEXT NOT NULL, "
+                "exit_code INTEGER NOT NULL, output BLOB)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS history_exit_code ON history (exit_code, id)")
+            try:
+                # Trigram tokens let MATCH find arbitrary substrings of 3+ characters
+                db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS history_fts "
+                           "USING fts5(command, output, content='', tokenize='trigram')")
+                self._fts = True
+            except sqlite3.OperationalError:
+                self._fts = False
+            self._rows = db.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+            if self._rows > self.max_stored:
+                self._prune(db)
+                db.commit()
+            self._db = db
+        return self._db
+
+    def append(self, command: str, output: str, exit_code: int) -> HistoryEntry:
+        output = ContextBuilder.summarize_output(output, self.max_output) if len(output) > self.max_output else output
+        entry = HistoryEntry(command, output, exit_code, time.time())
+        with self._lock:
+            self.entries.append(entry)
+            try:
+                db = self._connect()
+                cursor = db.execute("INSERT INTO history (ts, command, exit_code, output) VALUES (?, ?, ?, ?)",
+                                    (entry.timestamp, command, exit_code, entry.stored_output))
+                entry.id = cursor.lastrowid
+                if self._fts:
+                    db.execute("INSERT INTO history_fts (rowid, command, output) VALUES (?, ?, ?)",
+                               (entry.id, command, output))
+                self._rows += 1
+                if self._rows > self.max_stored:
+                    self._prune(db)
+                db.commit()
+            except (sqlite3.Error, OSError):
+                pass
+        return entry
+
+    def _prune(self, db):
+        rows = db.execute("SELECT id, command, exit_code, output, ts FROM history ORDER BY id DESC "
+                          "LIMIT -1 OFFSET ?", (self.max_stored,)).fetchall()
+        for id, command, exit_code, output, ts in rows:
+            if self._fts:
+                # Contentless FTS tables need the original text to delete a row
+                text = HistoryEntry(command, output, exit_code, ts).output
+                db.execute("INSERT INTO history_fts (history_fts, rowid, command, output) "
+                           "VALUES ('delete', ?, ?, ?)", (id, command, text))
+            db.execute("DELETE FROM history WHERE id = ?", (id,))
+        self._rows -= len(rows)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __getitem__(self, index):
+        return list(self.entries)[index]
+
+    def recent(self, limit: int = 20) -> List[HistoryEntry]:
+        """Most recent entries across sessions, oldest first"""
+        return self.search(limit=limit)
+
+    def search(self, pattern: Optional[str] = None, failed: bool = False, limit: int = 20) -> List[HistoryEntry]:
+        """Entries whose command or output contains pattern (case-insensitive), oldest first"""
+        try:
+            with self._lock:
+                db = self._connect()
+                where, params = [], []
+                if failed:
+                    where.append("h.exit_code != 0")
+                if pattern and self._fts and len(pattern) >= 3:
+                    where.append("h.id IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)")
+                    params.append('"' + pattern.replace('"', '""') + '"')
+                elif pattern:
+                    where.append("h.command LIKE ? OR h.output LIKE ?")
+                    params += [f"%{pattern}%"] * 2
+                sql = "SELECT h.id, h.ts, h.command, h.exit_code, h.output FROM history h"
+                if where:
+                    sql += " WHERE " + " AND ".join(f"({w})" for w in where)
+                rows = db.execute(sql + " ORDER BY h.id DESC", params)
+                results = []
+                needle = pattern.lower() if pattern else None
+                for id, ts, command, exit_code, output in rows:
+                    entry = HistoryEntry(command, output, exit_code, ts, id)
+                    if needle and needle not in command.lower() and needle not in entry.output.lower():
+                        continue
+                    results.append(entry)
+                    if len(results) >= limit:
+                        break
+                return results[::-1]
+        except (sqlite3.Error, OSError):
+            entries = [e for e in self.entries if (not failed or not e.success) and
+                       (not pattern or pattern.lower() in (e.command + e.output).lower())]
+            return entries[-limit:]
+
+    def relevant(self, text: str, limit: int = 5) -> List[HistoryEntry]:
+        """Past entries from any session that best match the words in text"""
+        words = re.findall(r"[\w./-]{3,}", text.lower())[:8]
+        if not words or not self._fts:
+            return []
+        try:
+            with self._lock:
+                query = " OR ".join('"' + w.replace('"', '""') + '"' for w in words)
+                rows = self._connect().execute(
+                    "SELECT h.id, h.ts, h.command, h.exit_code, h.output FROM history_fts f "
+                    "JOIN history h ON h.id = f.rowid WHERE history_fts MATCH ? ORDER BY f.rank LIMIT ?",
+                    (query, limit)).fetchall()
+            return [HistoryEntry(command, output, exit_code, ts, id) for id, ts, command, exit_code, output in rows]
+        except (sqlite3.Error, OSError):
+            return []
+
+class DocPage:
+    """Parsed documentation for one command: summary, sections, options and examples"""
+    __slots__ = ("name", "summary", "sections", "options", "flags", "examples")
+
+    def __init__(self, name: str, summary: str = "", sections: Optional[Dict[str, str]] = None,
+                 options: Optional[List] = None, examples: Optional[List] = None):
+        self.name = name
+        self.summary = summary
+        self.sections = sections or {}
+        # [label, description] pairs; flags maps every alias to its entry
+        self.options = options or []
+        self.examples = examples or []
+        self.flags = {}
+        for i, (label, _) in enumerate(self.options):
+            for flag in re.findall(r"(?<![\w-])(--?[A-Za-z0-9?][\w-]*)", label):
+                self.flags.setdefault(flag, i)
+
+    def option(self, flag: str) -> Optional[List[str]]:
+        i = self.flags.get(flag)
+        return None if i is None else self.options[i]
+
+    def to_blob(self) -> bytes:
+        return zlib.compress(json.dumps({
+            "summary": self.summary, "sections": self.sections,
+            "options": self.options, "examples": self.examples,
+        }, separators=(",", ":")).encode())
+
+    @classmethod
+    def from_blob(cls, name: str, blob: bytes) -> "DocPage":
+        data = json.loads(zlib.decompress(blob))
+        return cls(name, data["summary"], data["sections"], data["options"], data["examples"])
+
+class DocIndex:
+    """Offline command documentation built from local man and tldr pages.
+
+    A page is parsed the first time it is looked up (roff source is read
+    directly, so man itself is not needed) and stored zlib-compressed in a
+    SQLite index keyed on the source file's mtime; misses are remembered
+    for a day. Parsed pages are kept in an in-memory LRU. Nothing is run
+    through a shell.
+    """
+
+    MAN_SECTIONS = ("1", "8", "6", "5", "7")
+    TLDR_ROOTS = ("~/.local/share/tldr/pages", "~/.cache/tldr/pages", "~/.tldr/cache/pages",
+                  "~/.cache/tealdeer/tldr-pages/pages")
+    TLDR_PLATFORMS = ("common", "linux")
+    MISS_TTL = 24 * 3600
+    NAME = re.compile(r"^[A-Za-z0-9][\w.+-]*$")
+    ESCAPES = {"-": "-", "e": "\\", "&": "", "|": "", "^": "", " ": " ", "~": " ", "c": "", "%": "",
+               ",": "", "/": "", "0": " ",
+               "(aq": "'", "(dq": '"', "(em": "--", "(en": "-", "(bu": "*", "(lq": '"', "(rq": '"',
+               "(oq": "'", "(cq": "'", "(co": "(c)", "(mi": "-", "(hy": "-", "(ti": "~", "(ha": "^"}
+    MDOC_LAYOUT = {"Sm", "Bl", "El", "Bd", "Ed", "Dd", "Dt", "Os", "Xo", "Xc", "Bk", "Ek"}
+    ROFF_ESCAPE = re.compile(r"\\(f\[[^\]]*\]|f\(..|f.|s[+-]?\d+|\*\(..|\*\[[^\]]*\]|\*.|\(..|\[[^\]]*\]|.)")
+
+    def __init__(self, path: Optional[str] = None, man_path: Optional[List[str]] = None,
+                 cache_size: int = 128):
+        if path is None:
+            cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+            path = os.path.join(cache_home, "linux-assistant", "docs.sqlite3")
+        self.path = path
+        if man_path is None:
+            manpath = os.environ.get("MANPATH", "")
+            man_path = [p for p in manpath.split(":") if p] or \
+                ["/usr/local/share/man", "/usr/share/man", "/usr/local/man"]
+        self.man_path = man_path
+        self._lock = threading.Lock()
+        self._db = None
+        self.page = lru_cache(maxsize=cache_size)(self._load_page)
+
+    def _connect(self):
+        if self._db is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "name TEXT PRIMARY KEY, source TEXT NOT NULL, mtime REAL NOT NULL, body BLOB) WITHOUT ROWID"
+            )
+        return self._db
+
+    def _load_page(self, name: str) -> Optional[DocPage]:
+        """Documentation for name, from the index when current, else parsed from its source"""
+        if not self.NAME.match(name):
+            return None
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    "SELECT source, mtime, body FROM pages WHERE name = ?", (name,)).fetchone()
+        except (sqlite3.Error, OSError):
+            row = None
+        if row is not None:
+            source, mtime, body = row
+            if not source:
+                if time.time() - mtime < self.MISS_TTL:
+                    return None
+            elif self._mtime(source) == mtime:
+                return DocPage.from_blob(name, body)
+        page, source = self._parse(name)
+        try:
+            with self._lock:
+                db = self._connect()
+                with db:
+                    db.execute("INSERT OR REPLACE INTO pages (name, source, mtime, body) VALUES (?, ?, ?, ?)",
+                               (name, source or "", self._mtime(source) if source else time.time(),
+                                page.to_blob() if page else None))
+        except (sqlite3.Error, OSError):
+            pass
+        return page
+
+    @staticmethod
+    def _mtime(path: str) -> float:
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return -1.0
+
+    def _parse(self, name: str):
+        """Parse the man page for name, merged with its tldr page; returns (page, man or tldr path)"""
+        man = self.find_man_page(name)
+        tldr = self.find_tldr_page(name)
+        if not man and not tldr:
+            return None, None
+        page = self.parse_man(name, self._read(man)) if man else DocPage(name)
+        if tldr:
+            summary, examples = self.parse_tldr(self._read(tldr))
+            page.summary = page.summary or summary
+            page.examples = examples
+        return page, man or tldr
+
+    def find_man_page(self, name: str) -> Optional[str]:
+        for section in self.MAN_SECTIONS:
+            for root in self.man_path:
+                for candidate in (f"{root}/man{section}/{name}.{section}", f"{root}/man{section}/{name}.{section}.gz"):
+                    if os.path.isfile(candidate):
+                        return candidate
+                matches = glob.glob(f"{glob.escape(root)}/man{section}/{glob.escape(name)}.{section}*")
+                if matches:
+                    return sorted(matches)[0]
+        return None
+
+    def find_tldr_page(self, name: str) -> Optional[str]:
+        for root in self.TLDR_ROOTS:
+            for platform in self.TLDR_PLATFORMS:
+                candidate = os.path.join(os.path.expanduser(root), platform, f"{name}.md")
+                if os.path.isfile(candidate):
+                    return candidate
+        return None
+
+    def _read(self, path: str, depth: int = 0) -> str:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+            text = f.read()
+        # A ".so man1/other.1" stub points at the real page
+        match = re.match(r"\.so\s+(\S+)", text.lstrip())
+        if match and depth < 3:
+            root = os.path.dirname(os.path.dirname(path))
+            target = os.path.join(root, match.group(1))
+            for candidate in (target, target + ".gz"):
+                if os.path.isfile(candidate):
+                    return self._read(candidate, depth + 1)
+        return text
+
+    def roff_text(self, text: str) -> str:
+        """Plain text of a roff line: font changes dropped, special characters mapped"""
+        def escape(match):
+            code = match.group(1)
+            if code.startswith(("f", "s", "*")) and len(code) > 1 or code == "*":
+                return ""
+            return self.ESCAPES.get(code, "" if len(code) > 1 else code)
+        return self.ROFF_ESCAPE.sub(escape, text).strip()
+
+    def parse_man(self, name: str, source: str) -> DocPage:
+        """Split roff (man or mdoc macros) into sections and tagged option paragraphs"""
+        sections, options = {}, []
+        section, lines = None, []
+        tag, tag_next, paragraph_start, option_lines = None, False, False, []
+
+        def end_option():
+            nonlocal tag, option_lines
+            if tag and tag.lstrip().startswith("-"):
+                options.append([tag, " ".join(option_lines)[:600]])
+            tag, option_lines = None, []
+
+        for raw in source.splitlines():
+            if raw.startswith(('.\\"', "'\\\"", '.\\#')) or raw.strip() == ".":
+                continue
+            if raw.startswith((".", "'")):
+                parts = raw[1:].split(None, 1)
+                if not parts:
+                    continue
+                macro, args = parts[0], (parts[1] if len(parts) > 1 else "")
+                if macro in ("SH", "Sh"):
+                    end_option()
+                    if section:
+                        sections[section] = "\n".join(lines).strip()
+                    section, lines = self.roff_text(args.replace('"', "")).upper(), []
+                    continue
+                if macro in ("TP", "TQ"):
+                    end_option()
+                    tag_next = True
+                    continue
+                if macro in ("IP", "It"):
+                    end_option()
+                    tag = self._macro_text(macro, args) if macro == "It" else \
+                        self.roff_text((self._roff_args(args) or [""])[0])
+                    if tag:
+                        lines.append(tag)
+                    continue
+                if macro in ("PP", "LP", "P", "sp", "Pp", "SS", "Ss"):
+                    end_option()
+                    # DocBook output tags options as ".PP / -a, --all / .RS 4"
+                    paragraph_start = macro in ("PP", "LP", "P")
+                    lines.append("")
+                    if macro in ("SS", "Ss"):
+                        lines.append(self.roff_text(args.replace('"', "")))
+                    continue
+                text = self._macro_text(macro, args)
+                if not text:
+                    continue
+            else:
+                text = self.roff_text(raw.rstrip("\\"))
+                if not text:
+                    lines.append("")
+                    continue
+            starts_paragraph, paragraph_start = paragraph_start, False
+            if tag_next or starts_paragraph and text.startswith("-"):
+                tag, tag_next = text, False
+            elif tag is not None:
+                option_lines.append(text)
+            lines.append(text)
+        end_option()
+        if section:
+            sections[section] = "\n".join(lines).strip()
+        summary = " ".join(sections.get("NAME", "").split())
+        return DocPage(name, summary, sections, options)
+
+    @staticmethod
+    def _roff_args(args: str) -> List[str]:
+        try:
+            return shlex.split(args.replace("\\", "\\\\"))
+        except ValueError:
+            return args.split()
+
+    def _macro_text(self, macro: str, args: str) -> str:
+        """Text produced by a font or mdoc macro line; layout requests produce none"""
+        if macro in ("B", "I", "SM", "SB"):
+            return self.roff_text(args.replace('"', ""))
+        if macro in ("BR", "RB", "BI", "IB", "IR", "RI"):
+            return self.roff_text("".join(self._roff_args(args)))
+        if macro in self.MDOC_LAYOUT:
+            return ""
+        if macro[:1].isupper() and macro[1:2].islower() and len(macro) == 2:
+            # mdoc: "Fl x" is the option -x, other macro names are dropped
+            words = args.split()
+            out, flag = [], False
+            for word in words:
+                if word == "Fl":
+                    flag = True
+                elif len(word) == 2 and word[0].isupper() and word[1].islower():
+                    continue
+                else:
+                    out.append(("-" + word) if flag else word)
+                    flag = False
+            if flag:
+                out.append("-")
+            text = self.roff_text(" ".join(out))
+            if macro == "Nd":
+                return "- " + text
+            if macro == "Fl":
+                return "-" + text
+            return text
+        return ""
+
+    @staticmethod
+    def parse_tldr(text: str):
+        """Description and (description, command) examples from a tldr markdown page"""
+        summary, examples, pending = [], [], None
+        for line in text.splitlines():
+            line = line.strip()
+            if line.startswith(">") and "More information" not in line:
+                summary.append(line.lstrip("> ").strip())
+            elif line.startswith("- "):
+                pending = line[2:].rstrip(":")
+            elif line.startswith("`") and pending is not None:
+                examples.append([pending, line.strip("`").replace("{{", "").replace("}}", "")])
+                pending = None
+        return " ".join(summary), examples
+
+    def explain(self, program: str, args: List[str]) -> Optional[str]:
+        """Describe program and the flags used in args, or None if nothing is documented"""
+        name = os.path.basename(program)
+        page = None
+        if args and self.NAME.match(args[0]) and not args[0].startswith("-"):
+            # Subcommands such as "git commit" have pages like git-commit
+            page = self.page(f"{name}-{args[0]}")
+            if page:
+                name, args = page.name, args[1:]
+        page = page or self.page(name)
+        if page is None:
+            return None
+        out = [page.summary or name]
+        if name == "tar" and args and not args[0].startswith("-"):
+            # Traditional tar syntax bundles options without a dash: tar xzf
+            args = ["-" + args[0]] + args[1:]
+        known, unknown, seen = [], [], set()
+        for arg in args:
+            if arg == "--":
+                break
+            if not arg.startswith("-") or arg == "-":
+                continue
+            candidates = [arg.split("=", 1)[0]] if arg.startswith("--") or page.option(arg) else \
+                ["-" + c for c in arg[1:]]
+            for i, flag in enumerate(candidates):
+                entry = page.option(flag)
+                if entry is None:
+                    if i == 0:
+                        unknown.append(flag)
+                    # The rest is probably an attached value, as in -n5
+                    break
+                if entry[0] not in seen:
+                    seen.add(entry[0])
+                    known.append(entry)
+        for label, description in known:
+            out.append(f"  {label}: {self.brief(description)}")
+        if unknown:
+            out.append(f"  Not documented: {' '.join(unknown)}")
+        if not known:
+            if page.examples:
+                out.extend(f"  {desc}:\n    {cmd}" for desc, cmd in page.examples[:6])
+            else:
+                for section in ("SYNOPSIS", "DESCRIPTION"):
+                    paragraph = page.sections.get(section, "").strip().split("\n\n", 1)[0]
+                    if paragraph:
+                        out.append(f"{section}:\n  {' '.join(paragraph.split())[:400]}")
+        return "\n".join(out)
+
+    @staticmethod
+    def brief(text: str, limit: int = 200) -> str:
+        """First sentence of an option description, capped at limit characters"""
+        end = text.find(". ", 40)
+        if 0 < end < limit:
+            return text[:end + 1]
+        return text if len(text) <= limit else text[:limit].rsplit(" ", 1)[0] + "..."
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+class CrontabManager:
+    """Parse, validate and update a crontab, applying many changes in one write.
+
+    Job lines are compared on their normalized schedule and command, so
+    duplicates are skipped; comments, blank lines and variable assignments
+    are kept as they are. With path set the changes go to that file through
+    a temporary file and rename, otherwise the result is installed with
+    `crontab FILE`. Writers in this and other assistant processes are
+    serialized by a lock file. Editors that do not take it (crontab -e) are
+    caught by re-reading the crontab right before the new one is put in
+    place: if it changed since it was read, the changes are re-planned on
+    the new contents. Only an edit landing between that check and the
+    rename or install itself can still be lost.
+    """
+
+    MONTHS = ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec")
+    DAYS = ("sun", "mon", "tue", "wed", "thu", "fri", "sat")
+    # (name, lowest, highest, names numbered from lowest)
+    FIELDS = (("minute", 0, 59, ()), ("hour", 0, 23, ()), ("day of month", 1, 31, ()),
+              ("month", 1, 12, MONTHS), ("day of week", 0, 7, DAYS))
+    MACROS = {"@reboot": "@reboot", "@yearly": "@yearly", "@annually": "@yearly", "@monthly": "@monthly",
+              "@weekly": "@weekly", "@daily": "@daily", "@midnight": "@daily", "@hourly": "@hourly"}
+    ASSIGNMENT = re.compile(r"^\s*[A-Za-z_][A-Za-z0-9_]*\s*=")
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, path: Optional[str] = None, lock_path: Optional[str] = None):
+        self.path = path
+        if lock_path is None:
+            if path:
+                lock_path = path + ".lock"
+            else:
+                cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+                lock_path = os.path.join(cache_home, "linux-assistant", "crontab.lock")
+        self.lock_path = lock_path
+        self._lock = threading.Lock()
+
+    @classmethod
+    def validate(cls, schedule: str) -> str:
+        """Normalized form of a schedule; raises ValueError if it is not valid"""
+        fields = schedule.lower().split()
+        if len(fields) == 1 and fields[0].startswith("@"):
+            if fields[0] not in cls.MACROS:
+                raise ValueError(f"unknown schedule {fields[0]}")
+            return cls.MACROS[fields[0]]
+        if len(fields) != 5:
+            raise ValueError(f"expected 5 schedule fields, got {len(fields)}")
+        for value, (name, low, high, names) in zip(fields, cls.FIELDS):
+            for item in value.split(","):
+                base, _, step = item.partition("/")
+                if step and not (step.isdigit() and int(step) > 0):
+                    raise ValueError(f"bad step in {name} field: {item}")
+                if base == "*":
+                    continue
+                bounds = base.split("-")
+                if len(bounds) > 2 or (step and len(bounds) == 1):
+                    raise ValueError(f"bad {name} field: {item}")
+                numbers = []
+                for bound in bounds:
+                    if bound in names:
+                        numbers.append(names.index(bound) + low)
+                    elif bound.isdigit() and low <= int(bound) <= high:
+                        numbers.append(int(bound))
+                    else:
+                        raise ValueError(f"{name} out of range ({low}-{high}): {bound or item}")
+                if len(numbers) == 2 and numbers[0] > numbers[1]:
+                    raise ValueError(f"reversed range in {name} field: {item}")
+        return " ".join(fields)
+
+    @classmethod
+    def parse_line(cls, line: str):
+        """(schedule, command) for a job line, None for comments, blanks and assignments"""
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#") or cls.ASSIGNMENT.match(stripped):
+            return None
+        parts = stripped.split(None, 1 if stripped.startswith("@") else 5)
+        if len(parts) < (2 if stripped.startswith("@") else 6):
+            raise ValueError(f"missing command: {stripped}")
+        return " ".join(parts[:-1]), parts[-1].strip()
+
+    @classmethod
+    def parse_job(cls, line: str) -> str:
+        """Validated, normalized crontab line for a job; raises ValueError"""
+        job = cls.parse_line(line)
+        if job is None:
+            raise ValueError(f"not a cron job: {line.strip()}")
+        return f"{cls.validate(job[0])} {job[1]}"
+
+    @classmethod
+    def job_key(cls, line: str):
+        try:
+            job = cls.parse_line(line)
+            return None if job is None else (cls.validate(job[0]), job[1])
+        except ValueError:
+            return None
+
+    @classmethod
+    def plan(cls, text: str, add: Iterable[str] = (), remove: Iterable[str] = ()):
+        """New crontab text plus the lines added and removed; unknown removals and duplicates are ignored"""
+        lines = text.splitlines()
+        remove_keys = {cls.job_key(cls.parse_job(line)) for line in remove}
+        kept, removed, present = [], [], set()
+        for line in lines:
+            key = cls.job_key(line)
+            if key is not None and key in remove_keys:
+                removed.append(line)
+                continue
+            if key is not None:
+                present.add(key)
+            kept.append(line)
+        added = []
+        for line in add:
+            job = cls.parse_job(line)
+            key = cls.job_key(job)
+            if key not in present and key not in remove_keys:
+                present.add(key)
+                added.append(job)
+        new_text = "\n".join(kept + added)
+        return (new_text + "\n" if new_text else ""), added, removed
+
+    def read(self) -> str:
+        if self.path:
+            try:
+                with open(self.path) as f:
+                    return f.read()
+            except FileNotFoundError:
+                return ""
+        result = subprocess.run(["crontab", "-l"], capture_output=True, text=True)
+        if result.returncode != 0:
+            if "no crontab" in result.stderr.lower():
+                return ""
+            raise RuntimeError(f"crontab -l failed: {result.stderr.strip()}")
+        return result.stdout
+
+    def write(self, text: str, expected: Optional[str] = None) -> bool:
+        """Install text; with expected, only if the crontab still holds it (False otherwise)"""
+        directory = os.path.dirname(os.path.abspath(self.path)) if self.path else None
+        fd, tmp = tempfile.mkstemp(prefix=".crontab-", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(text)
+            if self.path and os.path.exists(self.path):
+                os.chmod(tmp, os.stat(self.path).st_mode & 0o777)
+            if expected is not None and self.read() != expected:
+                return False
+            if self.path:
+                os.replace(tmp, self.path)
+                return True
+            result = subprocess.run(["crontab", tmp], capture_output=True, text=True)
+            if result.returncode != 0:
+                raise RuntimeError(f"crontab install failed: {result.stderr.strip()}")
+            return True
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def apply(self, add: Iterable[str] = (), remove: Iterable[str] = ()):
+        """Apply all additions and removals in one write; returns (added, removed) lines"""
+        add, remove = list(add), list(remove)
+        os.makedirs(os.path.dirname(os.path.abspath(self.lock_path)), exist_ok=True)
+        with self._lock, open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for _ in range(self.MAX_ATTEMPTS):
+                original = self.read()
+                text, added, removed = self.plan(original, add, remove)
+                if not added and not removed:
+                    return [], []
+                # False if edited since the read by something that does not take our lock
+                if self.write(text, expected=original):
+                    return added, removed
+        raise RuntimeError("crontab kept changing while updating it; nothing was written")
+
+REPL_COMMANDS = (
+    "ask [question]: Ask about terminal history",
+    "analyze: Explain last command output",
+    "task [description]: Run multi-step task",
+    "script [description]: Generate a bash script",
+    "explain [command]: Explain a command",
+    "schedule [description]: Schedule a task with cron",
+    "chat: Enter chat mode",
+    "set model [model_name|auto]: Switch AI models, or route to the fastest one",
+    "set timeout [seconds|off]: Limit command run time",
+    "set cache [on|off|clear]: Control the AI response cache",
+    "log [N] [--failed] [--grep PATTERN]: View command history",
+    "stats: Show AI latency, token and command metrics",
+    "help: Show available commands",
+    "exit: Quit the program",
+)
+
 class SimpleLinuxAssistant:
     COLORS = {
         "command": "\033[33m",   # Yellow
@@ -23,120 +3069,201 @@ class SimpleLinuxAssistant:
         "warning": "\033[33m",   # Yellow warning
     }
 
-    DANGEROUS_COMMANDS = [
-        "rm -rf", "dd", "mkfs", "shred",
-        "fdisk", "mv", "chmod 777", "> /dev/sda"
-    ]
+    # system_context fields a cached answer may depend on
+    CACHE_CONTEXT_FIELDS = ("os", "package_manager", "work_dir")
 
-    def __init__(self, initial_model: AIModel):
+    # Commands at or above this risk need confirmation
+    CONFIRM_RISK = RiskLevel.HIGH
+    classifier = CommandClassifier()
+    triage = ErrorTriage()
+    # Seconds a command must keep running after an unexplained error before a fix is requested early
+    SPECULATE_AFTER = 0.5
+    API_KEY_ENV = {
+        AIModel.DEEPSEEK: ('DEEPSEEK_API_KEY', "DeepSeek"),
+        AIModel.GEMINI: ('GEMINI_API_KEY', "Google AI"),
+    }
+
+    def __init__(self, initial_model: AIModel, interactive: bool = True,
+                 providers: Optional[Dict[AIModel, AIProvider]] = None):
         self.ai_model = initial_model
+        self.interactive = interactive
         self.api_keys = {
             AIModel.DEEPSEEK: None,
             AIModel.GEMINI: None
         }
         self.clients = {}
-        self.history = []
-        self.work_dir = subprocess.getoutput("pwd")
+        hedge_after = os.environ.get('ASSISTANT_HEDGE_AFTER', 'auto').lower()
+        self.router = ProviderRouter(self.clients, lambda: self.ai_model,
+                                     hedge_after=None if hedge_after in ('auto', 'off') else float(hedge_after),
+                                     hedging=hedge_after != 'off')
+        self.loop = AsyncLoop()
+        self.metrics = Metrics(os.environ.get('ASSISTANT_METRICS_JSONL'), os.environ.get('ASSISTANT_METRICS_PROM'))
+        self.request_timeout = float(os.environ.get('ASSISTANT_REQUEST_TIMEOUT', '60'))
+        # Ask for a fix while a failing command is still running; costs a request if it then succeeds
+        self.speculative_suggestions = os.environ.get('ASSISTANT_SPECULATE', '1') != '0'
+        self.history = HistoryStore()
+        self.work_dir = os.getcwd()
+        self.shell = ShellSession(self.work_dir, terminal=ForegroundTerminal.attach() if interactive else None)
+        self.executor = StreamingExecutor()
+        self.max_parallel_steps = int(os.environ.get('ASSISTANT_MAX_PARALLEL_STEPS', '4'))
+        self._print_lock = threading.Lock()
+        self.command_timeout = self.parse_timeout(os.environ.get('ASSISTANT_COMMAND_TIMEOUT', 'off'))
+        self.last_result = None
+        self.context_builder = ContextBuilder(int(os.environ.get('ASSISTANT_CONTEXT_TOKENS', '2000')))
+        self.response_cache = ResponseCache(enabled=os.environ.get('ASSISTANT_NO_CACHE') != '1')
+        self.docs = DocIndex()
+        self.crontab = CrontabManager(os.environ.get('ASSISTANT_CRONTAB'))
         self.system_context = self.get_system_context()
+        if providers:
+            # Ready-made providers, e.g. fakes for the --check-* commands
+            self.clients.update(providers)
+            return
         self.setup_model(self.ai_model)
+        # Other models with a key in the environment serve as hedges and fallbacks
+        for model, (env_var, _) in self.API_KEY_ENV.items():
+            if model not in self.clients and os.environ.get(env_var):
+                self.setup_model(model)
 
-    def get_system_context(self) -> Dict:
-        """Collect critical system information"""
-        return {
-            "os": subprocess.getoutput("cat /etc/os-release | grep PRETTY_NAME | cut -d'\"' -f2"),
-            "work_dir": self.work_dir,
-            "package_manager": "apt" if os.path.exists("/usr/bin/apt") else "rpm",
-            "critical_services": subprocess.getoutput("systemctl list-units --type=service --state=running --no-legend | grep -E '(ssh|nginx|apache|postgres|mysql)' | cut -d' ' -f1"),
-            "disk_space": subprocess.getoutput("df -h --output=source,pcent,target | grep -v snap"),
-            "network_ips": subprocess.getoutput("ip -brief address | awk '{print $1,$3}'"),
-            "cpu_cores": os.cpu_count(),
-            "memory_total": subprocess.getoutput("free -h | awk '/Mem:/ {print $2}'"),
-            "essential_env_vars": "\n".join([f"{k}=[...]" if len(v) > 50 else f"{k}={v}" for k,v in os.environ.items() if k in {'PATH','USER','HOME','LANG'}]),
-        }
+    def get_system_context(self) -> SystemContext:
+        """Collect critical system information lazily, probing in the background"""
+        context = SystemContext(lambda: self.work_dir)
+        context.prefetch()
+        return context
 
     def setup_model(self, model: AIModel):
         try:
-            if model == AIModel.DEEPSEEK and not self.api_keys[model]:
-                key = os.environ.get('DEEPSEEK_API_KEY')
+            if not self.api_keys[model]:
+                env_var, label = self.API_KEY_ENV[model]
+                key = os.environ.get(env_var)
+                if not key and not self.interactive:
+                    raise RuntimeError(f"{env_var} is not set")
                 if not key:
-                    key = input("Enter DeepSeek API key: ")
+                    key = input(f"Enter {label} API key: ")
                 self.api_keys[model] = key
-                self.clients[model] = OpenAI(api_key=key, base_url="https://api.deepseek.com")
-            
-            elif model == AIModel.GEMINI and not self.api_keys[model]:
-                key = os.environ.get('GEMINI_API_KEY')
-                if not key:
-                    key = input("Enter Google AI API key: ")
-                self.api_keys[model] = key
-                genai.configure(api_key=key)
-                self.clients[model] = genai.GenerativeModel('gemini-2.5-pro-exp-03-25')
+                self.clients[model] = PROVIDERS[model](key, timeout=self.request_timeout, metrics=self.metrics)
+                # Import the SDK and build its client off the critical path
+                self.loop.submit(self.clients[model].warm_up())
         
         except Exception as e:
             print(f"{self.COLORS['error']}Model setup failed: {str(e)}{self.COLORS['reset']}")
 
+    def close(self):
+        """Shut down the shell session and provider connections"""
+        self.shell.close()
+        for client in self.clients.values():
+            try:
+                self.loop.submit(client.aclose()).result(timeout=5)
+            except Exception:
+                pass
+        self.loop.close()
+
     def check_dangerous_command(self, command: str) -> bool:
         """Check if command is potentially dangerous"""
-        return any(dc in command for dc in self.DANGEROUS_COMMANDS)
+        return self.classifier.classify(command).level >= self.CONFIRM_RISK
+
+    def describe_risk(self, command: str) -> str:
+        risk = self.classifier.classify(command)
+        return f"{risk.level.name}: {'; '.join(risk.reasons)}" if risk.reasons else risk.level.name
+
+    @staticmethod
+    def parse_timeout(value: str) -> Optional[float]:
+        """Parse a timeout setting in seconds; 'off', 'none' or 0 disable it"""
+        if value.strip().lower() in ('', 'off', 'none', '0'):
+            return None
+        seconds = float(value)
+        if seconds < 0:
+            raise ValueError("timeout must be positive")
+        return seconds
+
+    def print_output(self, stream: str, text: str):
+        """Write a chunk of command output to the terminal as it arrives"""
+        color = self.COLORS['output'] if stream == "stdout" else self.COLORS['error']
+        sys.stdout.write(f"{color}{text}{self.COLORS['reset']}")
+        sys.stdout.flush()
 
-    def execute(self, command: str) -> str:
+    def execute(self, command: str, on_output: Optional[Callable[[str, str], None]] = None) -> str:
+        """Run a command in the shell session, streaming its output"""
+        self.last_result = None
         try:
             # Safety check
             if self.check_dangerous_command(command):
-                confirm = input(f"{self.COLORS['warning']}WARNING: This command is dangerous. Confirm? [y/N] {self.COLORS['reset']}")
+                confirm = input(f"{self.COLORS['warning']}WARNING: This command is dangerous ({self.describe_risk(command)}). Confirm? [y/N] {self.COLORS['reset']}")
                 if confirm.lower() != 'y':
+                    print("Command cancelled by user")
                     return "Command cancelled by user\n"
 
-            result = subprocess.run(
-		            command,  # Pass the full string, not shlex.split()
-		            shell=True,  # Critical for pipes/operators
-		            stdout=subprocess.PIPE,
-		            stderr=subprocess.PIPE,
-		            text=True,
-		            timeout=30,  # Optional: Increase for long-running tasks
-		            cwd=self.work_dir
-		        )
-            output = result.stdout if result.returncode == 0 else result.stderr
-            output = output if output.endswith('\n') else output + '\n'
-            self.history.append({"command": command, "output": output, "success": result.returncode == 0})
-            return output
+            result = self.shell.run(
+                command,
+                on_output=on_output or self.print_output,
+                timeout=self.command_timeout,
+            )
+            self.work_dir = self.shell.cwd
+            if result.timed_out:
+                print(f"{self.COLORS['error']}Command timed out after {self.command_timeout} seconds{self.COLORS['reset']}")
+            self.last_result = result
+            return self.record_result(result)
         except Exception as e:
             error_msg = f"Error: {str(e)}\n"
-            self.history.append({"command": command, "output": error_msg, "success": False})
-            return error_msg
+            self.last_result = CommandResult(command, -1, stderr=error_msg)
+            print(f"{self.COLORS['error']}{error_msg}{self.COLORS['reset']}", end='')
+            return self.record_result(self.last_result)
 
-    def remove_markdown(self, text: str) -> str:
-        """Remove markdown formatting from text"""
-        text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)  # Remove bold
-        text = re.sub(r'```.*?\n(.*?)```', r'\1', text, flags=re.DOTALL)  # Remove code blocks
-        text = re.sub(r'`(.*?)`', r'\1', text)  # Remove inline code
-        text = re.sub(r'\* (.*)', r'- \1', text)  # Convert markdown lists to plain
-        return text.strip()
+    def record_result(self, result: CommandResult) -> str:
+        """Add a finished command to the history and return its display output"""
+        self.metrics.record_command(result)
+        output = result.stdout if result.exit_code == 0 else result.stderr
+        output = output if output.endswith('\n') else output + '\n'
+        self.history.append(result.command, output, result.exit_code)
+        # A mount, network or service change would otherwise show stale facts until the TTL expires
+        self.system_context.invalidate_after(program for program, _ in self.classifier.programs(result.command))
+        return output
+
+    def diagnose(self, result: CommandResult) -> Optional[Diagnosis]:
+        return self.triage.diagnose(result, self.system_context["package_manager"])
+
+    def failure_prompt(self, command: str, excerpt: str, exit_code: Optional[int] = None) -> str:
+        """Compact request for a fix, carrying only the extracted error lines"""
+        status = f"failed with exit code {exit_code}" if exit_code is not None else "is failing"
+        return f"The command `{command}` {status}. Error output:\n{excerpt}\nSuggest a command that fixes it."
 
     def remove_markdown(self, text: str) -> str:
         """Remove markdown formatting from text"""
-        text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)  # Remove bold
-        text = re.sub(r'```.*?\n(.*?)```', r'\1', text, flags=re.DOTALL)  # Remove code blocks
-        text = re.sub(r'`(.*?)`', r'\1', text)  # Remove inline code
-        text = re.sub(r'\* (.*)', r'- \1', text)  # Convert markdown lists to plain
-        return text.strip()
+        return MarkdownStreamRenderer.render(text).strip()
+
+    def markdown_renderer(self, color: str) -> MarkdownStreamRenderer:
+        """Streaming renderer that shows code blocks in the command color"""
+        return MarkdownStreamRenderer(code_style=self.COLORS['command'], text_style=color)
+
+    def get_ai_response(self, prompt: str, question_mode: bool = False, use_cache: bool = True,
+                        on_event: Optional[Callable] = None) -> dict:
+        future = self.get_ai_response_future(prompt, question_mode, use_cache, on_event)
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            future.cancel()
+            raise
+
+    def get_ai_response_future(self, prompt: str, question_mode: bool = False, use_cache: bool = True,
+                               on_event: Optional[Callable] = None) -> Future:
+        """Start a structured request in the background; the future resolves to the response dict.
 
-    def get_ai_response(self, prompt: str, question_mode: bool = False) -> dict:
+        With on_event the reply is streamed and on_event(key, index, value)
+        is called (from the loop thread) for each value as soon as it is
+        complete; a cached response is replayed through it immediately.
+        """
         context = {
-            "system_info": self.system_context,
-            "command_history": self.history[-5:]
+            "system_info": self.system_context.snapshot(),
+            "command_history": self.history[-self.context_builder.history_window:]
         }
 
+        system_str = self.context_builder.system_section(context['system_info'])
         history_str = ""
         if question_mode:
-            history_entries = []
-            for c in context['command_history']:
-                entry = f"Command: {c['command']}\nOutput: {c['output']}\nSuccess: {c['success']}"
-                history_entries.append(entry)
-            history_str = "Recent commands:\n" + "\n".join(history_entries)
+            history_str = "Recent commands:\n" + self.context_builder.history_section(context["command_history"])
 
         system_prompt = f"""Respond ONLY with valid JSON. Linux expert assistant. Context:
-        {json.dumps({k:(v[:75]+'...' if isinstance(v,str) and len(v)>75 else v) for k,v in context['system_info'].items()}, indent=2)}
-        {history_str[:200]}...
+        {system_str}
+        {history_str}
         Response format:
         {{
             "analysis": "concise technical analysis",
@@ -144,69 +3271,207 @@ class SimpleLinuxAssistant:
             "rollback": ["undo-command1", "undo-command2"]
         }}"""
 
+        cache_key = self.response_cache.make_key(
+            self.ai_model.value, prompt,
+            {"context": {k: context['system_info'].get(k) for k in self.CACHE_CONTEXT_FIELDS},
+             "history": history_str}
+        )
+        if use_cache:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                self.metrics.record_ai_call(self.ai_model.value, "complete", 0.0, cache_hit=True)
+                if on_event:
+                    for event in JSONStreamParser.iter_events(cached):
+                        on_event(*event)
+                future = Future()
+                future.set_result(cached)
+                return future
+
+        future = self.loop.submit(self.request_ai_response(prompt, system_prompt, on_event))
+        if use_cache:
+            def store(f):
+                # A repaired reply may be a truncated plan; ask again next time instead
+                if not f.cancelled() and f.exception() is None and not {"error", "_repaired"} & set(f.result()):
+                    self.response_cache.put(cache_key, f.result())
+            future.add_done_callback(store)
+        return future
+
+    async def request_ai_response(self, prompt: str, system_prompt: str,
+                                  on_event: Optional[Callable] = None) -> dict:
+        """Send a JSON-mode request to the active model, streaming it when on_event is set"""
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ]
         try:
-            if self.ai_model == AIModel.DEEPSEEK:
-                response = self.clients[AIModel.DEEPSEEK].chat.completions.create(
-                    model="deepseek-chat",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": prompt}
-                    ],
-                    response_format={"type": "json_object"}
-                )
-                return json.loads(response.choices[0].message.content)
-            
-            elif self.ai_model == AIModel.GEMINI:
-                response = self.clients[AIModel.GEMINI].generate_content(
-                    f"{system_prompt}\nUser question: {prompt}"
-                )
-                # Handle Gemini's text output format
-                if response.text.startswith('```json'):
-                    json_str = response.text.split('```json')[1].split('```')[0].strip()
-                else:
-                    json_str = response.text
-                return json.loads(json_str)
-        
+            if on_event is None:
+                text = await self.router.complete(messages, json_mode=True)
+                return parse_json_response(text)
+            parser = JSONStreamParser()
+            async for chunk in self.router.stream(messages, json_mode=True):
+                for event in parser.feed(chunk):
+                    on_event(*event)
+            return parser.close()
         except Exception as e:
             return {"error": str(e)}
 
+    def plan_task(self, task_description: str, on_event: Optional[Callable] = None) -> dict:
+        """Ask the model for a step plan, with optional dependencies and per-step rollback"""
+        return self.get_ai_response(
+            f"Break this task into Linux commands: {task_description}\n"
+            "If some commands do not depend on each other, also return \"depends_on\": a list with, "
+            "for each command, the 1-based numbers of the earlier commands it must wait for. "
+            "Give one rollback command per command, in the same order (empty string if nothing to undo).",
+            on_event=on_event
+        )
+
     def handle_multi_step_task(self, task_description: str):
         """Handle complex tasks with multiple commands"""
-        response = self.get_ai_response(f"Break this task into Linux commands: {task_description}")
-        
+        shown = {}
+        try:
+            response = self.plan_task(task_description, on_event=lambda *event: self.show_plan_event(shown, *event))
+        except KeyboardInterrupt:
+            print(f"{self.COLORS['warning']}\nPlanning cancelled{self.COLORS['reset']}")
+            return
+
         # Handle potential errors in response
         if "error" in response:
             print(f"{self.COLORS['error']}AI Error: {response['error']}{self.COLORS['reset']}")
             return
             
-        commands = response.get("commands", [])
+        steps = TaskStep.from_plan(response)
         
-        if not commands:
+        if not steps:
             print(f"{self.COLORS['error']}No commands generated for task{self.COLORS['reset']}")
             return
 
-        print(f"{self.COLORS['analysis']}\nTask Plan:{self.COLORS['reset']}")
-        for i, cmd in enumerate(commands, 1):
-            print(f"{i}. {cmd}")
+        parallel = any(s.depends_on != ([s.index - 1] if s.index > 1 else []) for s in steps)
+        if any(shown.get(s.index) != s.command for s in steps):
+            # Streaming missed or mis-shaped some steps (e.g. a repaired reply); show the final plan
+            print(f"{self.COLORS['analysis']}\nTask Plan:{self.COLORS['reset']}")
+            for step in steps:
+                after = f"  (after {', '.join(map(str, step.depends_on))})" if parallel and step.depends_on else ""
+                print(f"{step.index}. {step.command}{after}")
+        elif parallel:
+            print("Dependencies: " + "; ".join(
+                f"{s.index} after {', '.join(map(str, s.depends_on))}" for s in steps if s.depends_on))
+        if response.get("_repaired"):
+            print(f"{self.COLORS['warning']}The reply was cut off or malformed and had to be repaired: "
+                  f"steps or rollback commands may be missing.{self.COLORS['reset']}")
         
         confirm = input(f"{self.COLORS['warning']}Run all commands? [y/N] {self.COLORS['reset']}")
         if confirm.lower() != 'y':
             return
 
-        for cmd in commands:
-            print(f"\n{self.COLORS['command']}Executing: {cmd}{self.COLORS['reset']}")
-            output = self.execute(cmd)
-            print(f"{self.COLORS['output']}{output}{self.COLORS['reset']}", end='')
-
-            if "error" in output.lower():
-                print(f"{self.COLORS['warning']}\nError detected. Suggesting rollback...{self.COLORS['reset']}")
-                if response.get('rollback'):
-                    print(f"Rollback commands: {response['rollback']}")
-                    rb_confirm = input(f"{self.COLORS['warning']}Run rollback? [y/N] {self.COLORS['reset']}")
-                    if rb_confirm.lower() == 'y':
-                        for rb_cmd in response['rollback']:
-                            self.execute(rb_cmd)
-                break
+        # Confirm dangerous steps up front; workers must not prompt concurrently
+        for step in steps:
+            if self.check_dangerous_command(step.command):
+                confirm = input(f"{self.COLORS['warning']}WARNING: step {step.index} ({step.command}) is dangerous ({self.describe_risk(step.command)}). Confirm? [y/N] {self.COLORS['reset']}")
+                if confirm.lower() != 'y':
+                    print("Task cancelled by user")
+                    return
+
+        if parallel:
+            # Independent steps run as separate bash processes from the current directory with
+            # the session's exported variables; aliases, functions and `cd` do not carry over
+            env = self.shell.environment()
+            run_step = lambda step: self.executor.run(
+                step.command, cwd=self.work_dir, on_output=self.step_output_printer(step),
+                timeout=self.command_timeout, env=env)
+            scheduler = StepScheduler(run_step, self.max_parallel_steps, cancel=self.executor.interrupt)
+        else:
+            # A plain sequence runs in the shell session so cd and variables carry over
+            def run_step(step):
+                print(f"\n{self.COLORS['command']}Executing: {step.command}{self.COLORS['reset']}")
+                result = self.shell.run(step.command, on_output=self.step_output_printer(step),
+                                        timeout=self.command_timeout)
+                self.work_dir = self.shell.cwd
+                return result
+            scheduler = StepScheduler(run_step, 1)
+
+        if parallel:
+            print(f"\n{self.COLORS['command']}Executing {len(steps)} steps, up to {self.max_parallel_steps} at a time{self.COLORS['reset']}")
+        ran = scheduler.run(steps)
+        for step in ran:
+            self.record_result(step.result)
+
+        failed = [s for s in ran if s.result.exit_code != 0]
+        if not failed:
+            return
+        for step in failed:
+            outcome = "was interrupted" if step.result.interrupted else f"failed with exit code {step.result.exit_code}"
+            print(f"{self.COLORS['warning']}\nStep {step.index} {outcome}{self.COLORS['reset']}")
+            diagnosis = self.diagnose(step.result)
+            if diagnosis:
+                fix = f" Try: {diagnosis.fix}" if diagnosis.fix else f" Check: {diagnosis.check}" if diagnosis.check else ""
+                print(f"{self.COLORS['analysis']}Diagnosis: {diagnosis.cause}.{fix}{self.COLORS['reset']}")
+        skipped = len(steps) - len(ran)
+        if skipped:
+            print(f"{self.COLORS['warning']}{skipped} step(s) not run{self.COLORS['reset']}")
+
+        # Undo the steps that completed, most recent first
+        rollback = [s.rollback for s in reversed(ran) if s.rollback.strip()]
+        if not rollback and response.get('rollback') and len(response['rollback']) != len(response.get('commands', [])):
+            # Rollback list doesn't line up with the steps; offer it as a whole
+            rollback = [str(c) for c in response['rollback'] if str(c).strip()]
+        if rollback:
+            print(f"{self.COLORS['warning']}Error detected. Suggesting rollback...{self.COLORS['reset']}")
+            print(f"Rollback commands: {rollback}")
+            rb_confirm = input(f"{self.COLORS['warning']}Run rollback? [y/N] {self.COLORS['reset']}")
+            if rb_confirm.lower() == 'y':
+                for rb_cmd in rollback:
+                    self.execute(rb_cmd)
+
+    def show_plan_event(self, shown: Dict[int, str], key: str, index: Optional[int], value):
+        """Print plan fields as they stream in, flagging risky steps before the plan is complete"""
+        if key == "analysis" and index is None and value:
+            print(f"{self.COLORS['analysis']}\n{self.remove_markdown(str(value))}{self.COLORS['reset']}")
+        elif key == "commands" and index is not None:
+            command = str(value.get("command", "")) if isinstance(value, dict) else str(value)
+            if not command.strip():
+                return
+            if not shown:
+                print(f"{self.COLORS['analysis']}\nTask Plan:{self.COLORS['reset']}")
+            shown[index + 1] = command
+            risk = ""
+            if self.check_dangerous_command(command):
+                risk = f"  {self.COLORS['warning']}[{self.describe_risk(command)}]{self.COLORS['reset']}"
+            print(f"{index + 1}. {command}{risk}", flush=True)
+
+    def step_output_printer(self, step: TaskStep) -> Callable[[str, str], None]:
+        """Output callback that prefixes each line with its step number"""
+        def on_output(stream: str, text: str):
+            with self._print_lock:
+                self.print_output(stream, f"[{step.index}] {text}")
+        return on_output
+
+    def show_log(self, args: str):
+        """Print stored history: log [N] [--failed] [--grep PATTERN]"""
+        try:
+            tokens = shlex.split(args)
+        except ValueError as e:
+            print(f"{self.COLORS['error']}Invalid log arguments: {e}{self.COLORS['reset']}")
+            return
+        limit, failed, pattern = 20, False, None
+        while tokens:
+            token = tokens.pop(0)
+            if token == '--failed':
+                failed = True
+            elif token == '--grep' and tokens:
+                pattern = tokens.pop(0)
+            elif token.isdigit():
+                limit = int(token)
+            else:
+                print(f"{self.COLORS['error']}Usage: log [N] [--failed] [--grep PATTERN]{self.COLORS['reset']}")
+                return
+        entries = self.history.search(pattern, failed, limit)
+        if not entries:
+            print("No matching history")
+        for entry in entries:
+            stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.timestamp))
+            print(f"{self.COLORS['command']}[{stamp}] {entry.command}{self.COLORS['reset']}")
+            print(f"Output: {self.context_builder.summarize_output(entry.output, 2000)}")
+            print(f"Success: {entry.success} (exit code {entry.exit_code})\n")
 
     def generate_script(self, task_description: str):
         """Generate and save a bash script for a task"""
@@ -227,41 +3492,64 @@ class SimpleLinuxAssistant:
             print(f"Execute with: ./{script_name}")
 
     def explain_command(self, command: str):
-        """Explain a command using man or tldr"""
+        """Explain a command from the local man/tldr index, asking the model only if it has nothing"""
         try:
-            summary = subprocess.getoutput(f"tldr {command} --short")
-            if "not found" in summary:
-                summary = subprocess.getoutput(f"man {command} | head -n 20")
-            print(f"{self.COLORS['analysis']}{summary}{self.COLORS['reset']}")
+            explanations = [self.docs.explain(program, args) for program, args in self.classifier.programs(command)]
+            if explanations and all(explanations):
+                print(f"{self.COLORS['analysis']}" + "\n\n".join(explanations) + f"{self.COLORS['reset']}")
+                return
+            self.stream_ai_response(f"Explain this Linux command and each of its options: {command}",
+                                    "You are a Linux expert. Explain commands concisely in plain text.")
+            print()
         except Exception as e:
             print(f"{self.COLORS['error']}Error fetching explanation: {str(e)}{self.COLORS['reset']}")
 
     def schedule_task(self, task_description: str):
         """Schedule a task using cron"""
-        response = self.get_ai_response(f"Generate a cron job for: {task_description}")
-        if response.get('commands'):
-            cron_job = response['commands'][0]
-            print(f"{self.COLORS['analysis']}Cron job: {cron_job}{self.COLORS['reset']}")
-            confirm = input(f"{self.COLORS['warning']}Add to crontab? [y/N] {self.COLORS['reset']}")
-            if confirm.lower() == 'y':
-                self.execute(f"(crontab -l; echo '{cron_job}') | crontab -")
-                print(f"{self.COLORS['analysis']}Cron job added.{self.COLORS['reset']}")
+        response = self.get_ai_response(
+            f"Generate a cron job for: {task_description}\n"
+            "Each entry of commands must be one complete crontab line: five schedule fields "
+            "(or an @ macro such as @daily) followed by the command."
+        )
+        if "error" in response:
+            print(f"{self.COLORS['error']}AI Error: {response['error']}{self.COLORS['reset']}")
+            return
+        jobs = []
+        for line in response.get('commands') or []:
+            try:
+                jobs.append(self.crontab.parse_job(str(line)))
+            except ValueError as e:
+                print(f"{self.COLORS['error']}Skipping invalid cron job {line!r}: {e}{self.COLORS['reset']}")
+        if not jobs:
+            return
+        for job in jobs:
+            risk = ""
+            command = self.crontab.parse_line(job)[1]
+            if self.check_dangerous_command(command):
+                risk = f"  {self.COLORS['warning']}[{self.describe_risk(command)}]{self.COLORS['reset']}"
+            print(f"{self.COLORS['analysis']}Cron job: {job}{self.COLORS['reset']}{risk}")
+        confirm = input(f"{self.COLORS['warning']}Add to crontab? [y/N] {self.COLORS['reset']}")
+        if confirm.lower() != 'y':
+            return
+        try:
+            added, _ = self.crontab.apply(add=jobs)
+        except (OSError, RuntimeError) as e:
+            print(f"{self.COLORS['error']}Could not update crontab: {e}{self.COLORS['reset']}")
+            return
+        skipped = len(jobs) - len(added)
+        print(f"{self.COLORS['analysis']}Added {len(added)} cron job(s)"
+              f"{f', {skipped} already present' if skipped else ''}.{self.COLORS['reset']}")
+
+    @staticmethod
+    def print_help():
+        print("Available commands:")
+        for line in REPL_COMMANDS:
+            print(f"- {line}")
 
     def run(self):
         print(f"{self.COLORS['analysis']}Enhanced Linux Assistant{self.COLORS['reset']}")
         print(f"Current AI model: {self.ai_model.value}\n")
-        print("Available commands:")
-        print("- ask [question]: Ask about terminal history")
-        print("- analyze: Explain last command output")
-        print("- task [description]: Run multi-step task")
-        print("- script [description]: Generate a bash script")
-        print("- explain [command]: Explain a command")
-        print("- schedule [description]: Schedule a task with cron")
-        print("- chat: Enter chat mode")
-        print("- set model [model_name]: Switch AI models")
-        print("- log: View command history")
-        print("- help: Show available commands")
-        print("- exit: Quit the program")
+        self.print_help()
         
         while True:
             try:
@@ -271,24 +3559,18 @@ class SimpleLinuxAssistant:
                     break
 
                 if user_input.lower() == 'help':
-                    print("Available commands:")
-                    print("- ask [question]: Ask about terminal history")
-                    print("- analyze: Explain last command output")
-                    print("- task [description]: Run multi-step task")
-                    print("- script [description]: Generate a bash script")
-                    print("- explain [command]: Explain a command")
-                    print("- schedule [description]: Schedule a task with cron")
-                    print("- chat: Enter chat mode")
-                    print("- set model [model_name]: Switch AI models")
-                    print("- log: View command history")
-                    print("- help: Show available commands")
-                    print("- exit: Quit the program")
+                    self.print_help()
                     continue
 
                 if user_input.lower().startswith('set model '):
                     new_model = user_input.split()[-1].lower()
+                    if new_model == 'auto':
+                        self.router.auto = True
+                        print(f"{self.COLORS['analysis']}Routing to the fastest healthy configured model{self.COLORS['reset']}")
+                        continue
                     try:
                         self.ai_model = AIModel(new_model)
+                        self.router.auto = False
                         if self.ai_model not in self.clients:
                             self.setup_model(self.ai_model)
                         print(f"{self.COLORS['analysis']}Switched to {new_model} model{self.COLORS['reset']}")
@@ -296,6 +3578,29 @@ class SimpleLinuxAssistant:
                         print(f"{self.COLORS['error']}Invalid model. Available: {[m.value for m in AIModel]}{self.COLORS['reset']}")
                     continue
 
+                if user_input.lower().startswith('set timeout '):
+                    try:
+                        self.command_timeout = self.parse_timeout(user_input.split()[-1])
+                        setting = f"{self.command_timeout:g} seconds" if self.command_timeout else "off"
+                        print(f"{self.COLORS['analysis']}Command timeout: {setting}{self.COLORS['reset']}")
+                    except ValueError:
+                        print(f"{self.COLORS['error']}Invalid timeout. Use seconds or 'off'{self.COLORS['reset']}")
+                    continue
+
+                if user_input.lower().startswith('set cache '):
+                    setting = user_input.split()[-1].lower()
+                    if setting in ('on', 'off'):
+                        self.response_cache.enabled = setting == 'on'
+                    elif setting == 'clear':
+                        self.response_cache.clear()
+                    else:
+                        print(f"{self.COLORS['error']}Usage: set cache [on|off|clear]{self.COLORS['reset']}")
+                        continue
+                    cache = self.response_cache
+                    print(f"{self.COLORS['analysis']}Response cache {'on' if cache.enabled else 'off'}: "
+                          f"{len(cache)} entries, {cache.hits} hits, {cache.misses} misses{self.COLORS['reset']}")
+                    continue
+
                 if user_input.lower().startswith('task '):
                     task_desc = user_input[5:].strip()
                     self.handle_multi_step_task(task_desc)
@@ -316,20 +3621,33 @@ class SimpleLinuxAssistant:
                     self.schedule_task(task_desc)
                     continue
 
-                if user_input.lower() == 'log':
-                    for entry in self.history:
-                        print(f"Command: {entry['command']}")
-                        print(f"Output: {entry['output']}")
-                        print(f"Success: {entry['success']}\n")
+                if user_input.lower() == 'stats':
+                    print(f"{self.COLORS['analysis']}" + "\n".join(self.metrics.summary()) + f"{self.COLORS['reset']}")
+                    cache = self.response_cache
+                    print(f"Response cache: {cache.hits} hits, {cache.misses} misses")
+                    print(self.router.summary())
+                    continue
+
+                if user_input.lower() == 'log' or user_input.lower().startswith('log '):
+                    self.show_log(user_input[3:].strip())
                     continue
 
                 if user_input.lower().startswith('ask '):
                     question = user_input[4:].strip()
-                    if not self.history:
+                    # Matching entries from earlier sessions first, then recent commands (from the
+                    # store when this session has none yet)
+                    window = self.context_builder.history_window
+                    recent = list(self.history)[-window:] or self.history.recent(window)
+                    recent_ids = {e.id for e in recent}
+                    related = [e for e in self.history.relevant(question) if e.id not in recent_ids]
+                    if not recent and not related:
                         print(f"{self.COLORS['error']}No history to analyze{self.COLORS['reset']}")
                         continue
-                    
-                    history_str = "\n".join([f"Command: {c['command']}\nOutput: {c['output'][:200]}" for c in self.history[-5:]])
+                    # The newest commands always stay (the question is usually about them); matches from
+                    # older sessions fill the rest of the window, or at most a quarter of a full one
+                    related = related[:max(window - len(recent), window // 4)]
+                    recent = recent[-(window - len(related)):]
+                    history_str = self.context_builder.history_section(related + recent, self.context_builder.budget)
                     system_prompt = f"""You are a Linux sysadmin assistant. Current directory: {self.work_dir}
                     Recent command history:
                     {history_str}
@@ -344,20 +3662,59 @@ class SimpleLinuxAssistant:
                     self.chat_mode()
                     continue
 
-                output = self.execute(user_input)
-                print(f"{self.COLORS['output']}{output}{self.COLORS['reset']}", end='')
+                suggestion = None
+                speculation = None
+                stderr_seen = []
+                def speculate():
+                    nonlocal suggestion
+                    suggestion = self.get_ai_response_future(
+                        self.failure_prompt(user_input, "".join(stderr_seen)[-1500:]))
+
+                def on_output(stream, text):
+                    nonlocal speculation
+                    self.print_output(stream, text)
+                    if stream != "stderr" or speculation is not None or not self.speculative_suggestions:
+                        return
+                    # An error the local rules can't explain in a command that keeps running:
+                    # ask for a fix while the output is still printing
+                    stderr_seen.append(text)
+                    seen = "".join(stderr_seen)
+                    if ErrorTriage.LOOKS_LIKE_ERROR.search(seen) and not self.triage.matches(seen):
+                        speculation = threading.Timer(self.SPECULATE_AFTER, speculate)
+                        speculation.daemon = True
+                        speculation.start()
 
-                if "Error" in output:
+                try:
+                    self.execute(user_input, on_output=on_output)
+                finally:
+                    if speculation is not None:
+                        speculation.cancel()
+                        speculation.join()
+
+                response = {}
+                diagnosis = self.diagnose(self.last_result) if self.last_result else None
+                if diagnosis:
+                    if suggestion:
+                        suggestion.cancel()
+                    print(f"{self.COLORS['analysis']}\nDiagnosis: {diagnosis.cause}{self.COLORS['reset']}")
+                    if diagnosis.fix:
+                        response = {"commands": [diagnosis.fix]}
+                    elif diagnosis.check:
+                        print(f"{self.COLORS['analysis']}To investigate: {diagnosis.check}{self.COLORS['reset']}")
+                elif self.last_result and self.last_result.failed:
                     print(f"{self.COLORS['analysis']}\nGetting suggestions...{self.COLORS['reset']}")
-                    response = self.get_ai_response(user_input)  # This stays JSON-based
-                    
-                    if response.get('commands'):
-                        cmd = response['commands'][0]
-                        print(f"\n{self.COLORS['command']}Suggested command: {cmd}{self.COLORS['reset']}")
-                        confirm = input("Run this? [y/N] ").lower()
-                        if confirm == 'y':
-                            output = self.execute(cmd)
-                            print(f"{self.COLORS['output']}{output}{self.COLORS['reset']}", end='')
+                    result = self.last_result
+                    response = (suggestion or self.get_ai_response_future(
+                        self.failure_prompt(user_input, self.triage.excerpt(result), result.exit_code))).result()
+                elif suggestion:
+                    suggestion.cancel()
+
+                if response.get('commands'):
+                    cmd = response['commands'][0]
+                    print(f"\n{self.COLORS['command']}Suggested command: {cmd}{self.COLORS['reset']}")
+                    confirm = input("Run this? [y/N] ").lower()
+                    if confirm == 'y':
+                        self.execute(cmd)
 
 
             except KeyboardInterrupt:
@@ -366,11 +3723,12 @@ class SimpleLinuxAssistant:
             except Exception as e:
                 print(f"{self.COLORS['error']}Error: {str(e)}{self.COLORS['reset']}")
 
-
+        self.close()
 
     def chat_mode(self):
         print(f"\n{self.COLORS['analysis']}Chat Mode ({self.ai_model.value}) - Type 'exit' to return{self.COLORS['reset']}")
-        chat_history = []
+        memory = ConversationMemory(self.summarize_conversation,
+                                    int(os.environ.get('ASSISTANT_CHAT_TOKENS', '3000')))
 
         while True:
             user_msg = input(f"{self.COLORS['command']}You: {self.COLORS['reset']}").strip()
@@ -379,86 +3737,48 @@ class SimpleLinuxAssistant:
                 return
 
             try:
-                if self.ai_model == AIModel.DEEPSEEK:
-                    # DeepSeek streaming (existing implementation)
-                    stream = self.clients[AIModel.DEEPSEEK].chat.completions.create(
-                        model="deepseek-chat",
-                        messages=[
-                            {"role": "system", "content": "You are a helpful AI assistant."},
-                            *chat_history,
-                            {"role": "user", "content": user_msg}
-                        ],
-                        stream=True
-                    )
-                    
-                    print(f"{self.COLORS['chat']}AI: ", end="", flush=True)
-                    full_response = []
-                    for chunk in stream:
-                        if chunk.choices[0].delta.content:
-                            content = chunk.choices[0].delta.content
-                            print(content, end="", flush=True)
-                            full_response.append(content)
-                    print(self.COLORS['reset'])
-                    chat_history.extend([
-                        {"role": "user", "content": user_msg},
-                        {"role": "assistant", "content": "".join(full_response)}
-                    ])
-
-                elif self.ai_model == AIModel.GEMINI:
-                    # Gemini streaming implementation
-                    print(f"{self.COLORS['chat']}AI: ", end="", flush=True)
-                    full_response = []
-                    
-                    # Enable streaming for Gemini
-                    response = self.clients[AIModel.GEMINI].generate_content(
-                        user_msg,
-                        stream=True
-                    )
-                    
-                    # Process streaming chunks
-                    for chunk in response:
-                        if chunk.text:
-                            print(chunk.text, end="", flush=True)
-                            full_response.append(chunk.text)
-                    
-                    print(self.COLORS['reset'])
-                    chat_history.extend([
-                        {"role": "user", "content": user_msg},
-                        {"role": "assistant", "content": "".join(full_response)}
-                    ])
+                messages = memory.messages("You are a helpful AI assistant.", user_msg)
+                print(f"{self.COLORS['chat']}AI: ", end="", flush=True)
+                full_response = []
+                renderer = self.markdown_renderer(self.COLORS['chat'])
+                try:
+                    for content in self.loop.iterate(self.router.stream(messages)):
+                        renderer.feed(content)
+                        full_response.append(content)
+                finally:
+                    renderer.close()
+                print(self.COLORS['reset'])
+                memory.add(user_msg, "".join(full_response))
 
             except Exception as e:
                 print(f"\n{self.COLORS['error']}Chat error: {str(e)}{self.COLORS['reset']}")
 
+    def summarize_conversation(self, summary: str, messages: List[Dict]) -> Future:
+        """Fold chat turns into the running summary in the background"""
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        return self.loop.submit(self.router.complete([
+            {"role": "system", "content": "Update the summary of a conversation between a user and a Linux "
+                                          "assistant. Keep facts, decisions, commands and open questions; "
+                                          "reply with the summary only, under 200 words."},
+            {"role": "user", "content": f"Current summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"}
+        ]))
+
     def stream_ai_response(self, prompt: str, system_prompt: str) -> str:
         try:
             full_response = []
             print(self.COLORS['analysis'], end="", flush=True)
 
-            if self.ai_model == AIModel.DEEPSEEK:
-                stream = self.clients[AIModel.DEEPSEEK].chat.completions.create(
-                    model="deepseek-chat",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": prompt}
-                    ],
-                    stream=True
-                )
-                for chunk in stream:
-                    if chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
-                        print(content, end="", flush=True)
-                        full_response.append(content)
-
-            elif self.ai_model == AIModel.GEMINI:
-                response = self.clients[AIModel.GEMINI].generate_content(
-                    f"{system_prompt}\n{prompt}", 
-                    stream=True
-                )
-                for chunk in response:
-                    if chunk.text:
-                        print(chunk.text, end="", flush=True)
-                        full_response.append(chunk.text)
+            messages = [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt}
+            ]
+            renderer = self.markdown_renderer(self.COLORS['analysis'])
+            try:
+                for content in self.loop.iterate(self.router.stream(messages)):
+                    renderer.feed(content)
+                    full_response.append(content)
+            finally:
+                renderer.close()
 
             print(self.COLORS['reset'], end="", flush=True)
             return ''.join(full_response)
@@ -469,20 +3789,429 @@ class SimpleLinuxAssistant:
 
                 
 
-if __name__ == "__main__":
-    print("Available AI models:")
-    for model in AIModel:
-        print(f"  - {model.value}")
-    
-    while True:
-        model_choice = input("\nChoose initial model (deepseek/gemini): ").strip().lower()
+class BatchRunner:
+    """Process JSONL requests headlessly through an assistant.
+
+    Each input line is {"id": ..., "type": "command"|"task"|"ask"|"cron", "input": ...};
+    lines that are not JSON are treated as tasks. Requests run concurrently
+    as they are read, so stdin can be fed continuously, and one JSON result
+    line is written per request as it completes. "cron" requests carry a
+    crontab line (with "remove": true to delete it) and are validated on
+    arrival but applied together in a single crontab write at the end.
+
+    auto_confirm controls what may run without a human: "never" runs only
+    explicitly given safe commands and returns plans unexecuted, "safe" also
+    runs AI-generated commands unless one is dangerous, and "all" runs
+    everything.
+    """
+
+    POLICIES = ("never", "safe", "all")
+    OUTPUT_LIMIT = 4000
+
+    def __init__(self, assistant: SimpleLinuxAssistant, concurrency: int = 4,
+                 auto_confirm: str = "safe", output: TextIO = sys.stdout):
+        if auto_confirm not in self.POLICIES:
+            raise ValueError(f"auto_confirm must be one of {self.POLICIES}")
+        self.assistant = assistant
+        self.concurrency = max(1, concurrency)
+        self.auto_confirm = auto_confirm
+        self.output = output
+        self.counts = {}
+        self.cron_requests = []
+        self._lock = threading.Lock()
+
+    def run(self, lines: Iterable[str]) -> Dict:
+        """Process every request and return result counts by status"""
+        slots = threading.BoundedSemaphore(self.concurrency)
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch") as pool:
+            for number, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                slots.acquire()
+                future = pool.submit(self.handle_line, number, line)
+                future.add_done_callback(lambda f: slots.release())
+        self.apply_cron()
+        return dict(self.counts)
+
+    def handle_line(self, number: int, line: str):
+        start = time.monotonic()
         try:
-            initial_model = AIModel(model_choice)
-            break
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError
         except ValueError:
-            print(f"Invalid model! Please choose from {[m.value for m in AIModel]}")
+            request = {"type": "task", "input": line.strip()}
+        result = {"id": request.get("id", number), "type": request.get("type", "task"), "input": request.get("input", "")}
+        try:
+            if result["type"] == "cron":
+                self.queue_cron(result, bool(request.get("remove")), start)
+                return
+            handler = {"command": self.run_command, "task": self.run_task, "ask": self.run_ask}.get(result["type"])
+            if handler is None:
+                raise ValueError(f"unknown request type {result['type']!r}")
+            result.update(handler(str(result["input"])))
+        except Exception as e:
+            result.update(status="error", error=str(e))
+        self.emit(result, start)
+
+    def emit(self, result: Dict, start: float):
+        result["duration"] = round(time.monotonic() - start, 3)
+        with self._lock:
+            self.counts[result["status"]] = self.counts.get(result["status"], 0) + 1
+            self.output.write(json.dumps(result) + "\n")
+            self.output.flush()
+
+    def allowed(self, command: str, generated: bool) -> bool:
+        if self.auto_confirm == "all":
+            return True
+        if generated and self.auto_confirm == "never":
+            return False
+        return not self.assistant.check_dangerous_command(command)
+
+    def execute(self, command: str) -> CommandResult:
+        result = self.assistant.executor.run(command, cwd=self.assistant.work_dir,
+                                             timeout=self.assistant.command_timeout)
+        self.assistant.record_result(result)
+        return result
+
+    def describe(self, result: CommandResult) -> Dict:
+        output = result.stdout if result.exit_code == 0 else result.stderr
+        return {"command": result.command, "exit_code": result.exit_code,
+                "output": ContextBuilder.summarize_output(output, self.OUTPUT_LIMIT),
+                "duration": round(result.duration, 3)}
+
+    def run_command(self, command: str) -> Dict:
+        if not self.allowed(command, generated=False):
+            return {"status": "skipped", "reason": "dangerous command"}
+        result = self.execute(command)
+        report = {"status": "ok" if result.exit_code == 0 else "failed", "results": [self.describe(result)]}
+        if result.exit_code != 0:
+            diagnosis = self.assistant.diagnose(result)
+            if diagnosis:
+                report["diagnosis"] = diagnosis.cause
+                suggestion = diagnosis.fix
+                if diagnosis.check:
+                    report.update(self.run_check(diagnosis.check))
+            else:
+                response = self.assistant.get_ai_response(
+                    self.assistant.failure_prompt(command, self.assistant.triage.excerpt(result), result.exit_code))
+                suggestion = (response.get("commands") or [None])[0]
+            report["suggestion"] = suggestion
+            if suggestion and self.auto_confirm != "all" and self.assistant.classifier.escalates(suggestion):
+                # A fix that adds sudo or installs packages needs a person (or --auto-confirm all)
+                report["reason"] = "suggestion needs privileges or installs packages"
+            elif suggestion and self.allowed(suggestion, generated=True):
+                retry = self.execute(suggestion)
+                report["results"].append(self.describe(retry))
+                report["status"] = "recovered" if retry.exit_code == 0 else "failed"
+        return report
+
+    def run_check(self, check: str) -> Dict:
+        """Run a diagnostic command and report its output; its success is not a recovery"""
+        if not self.allowed(check, generated=True) or \
+                (self.auto_confirm != "all" and self.assistant.classifier.escalates(check)):
+            return {"check": check}
+        return {"check": check, "check_result": self.describe(self.execute(check))}
+
+    def run_task(self, description: str) -> Dict:
+        response = self.assistant.plan_task(description)
+        if "error" in response:
+            return {"status": "error", "error": response["error"]}
+        steps = TaskStep.from_plan(response)
+        report = {"analysis": response.get("analysis", ""), "plan": [s.command for s in steps]}
+        if not steps:
+            return dict(report, status="error", error="no commands generated")
+        if response.get("_repaired") and self.auto_confirm != "all":
+            return dict(report, status="skipped", reason="reply was cut off or malformed; plan may be incomplete")
+        blocked = [s.command for s in steps if not self.allowed(s.command, generated=True)]
+        if blocked:
+            reason = "auto-confirm disabled" if self.auto_confirm == "never" else "dangerous command in plan"
+            return dict(report, status="skipped", reason=reason)
+        ran = StepScheduler(lambda step: self.execute(step.command), self.assistant.max_parallel_steps).run(steps)
+        failed = any(s.result.exit_code != 0 for s in ran)
+        return dict(report, status="failed" if failed else "ok",
+                    results=[dict(self.describe(s.result), step=s.index) for s in ran])
+
+    def queue_cron(self, result: Dict, remove: bool, start: float):
+        job = CrontabManager.parse_job(str(result["input"]))
+        if not remove and not self.allowed(CrontabManager.parse_line(job)[1], generated=False):
+            result.update(status="skipped", reason="dangerous command")
+            self.emit(result, start)
+            return
+        with self._lock:
+            self.cron_requests.append((result, job, remove, start))
+
+    def apply_cron(self):
+        """Write every queued cron change at once and report each request"""
+        if not self.cron_requests:
+            return
+        requests, self.cron_requests = self.cron_requests, []
+        try:
+            added, removed = self.assistant.crontab.apply(
+                add=[job for _, job, remove, _ in requests if not remove],
+                remove=[job for _, job, remove, _ in requests if remove])
+        except (OSError, RuntimeError) as e:
+            for result, _, _, start in requests:
+                self.emit(dict(result, status="error", error=str(e)), start)
+            return
+        changed = {CrontabManager.job_key(line) for line in added + removed}
+        for result, job, _, start in requests:
+            key = CrontabManager.job_key(job)
+            status = "ok" if key in changed else "unchanged"
+            changed.discard(key)
+            self.emit(dict(result, status=status, cron=job), start)
+
+    def run_ask(self, question: str) -> Dict:
+        response = self.assistant.get_ai_response(question, question_mode=True)
+        if "error" in response:
+            return {"status": "error", "error": response["error"]}
+        return {"status": "ok", "response": response}
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Enhanced Linux Assistant",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog="interactive commands:\n" + "\n".join(f"  {c}" for c in REPL_COMMANDS))
+    parser.add_argument("--model", choices=[m.value for m in AIModel],
+                        help="AI model to use (prompted for interactively if omitted)")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="process JSONL requests from FILE ('-' for stdin) instead of the REPL")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="requests processed at once in batch mode (default: 4)")
+    parser.add_argument("--auto-confirm", choices=BatchRunner.POLICIES, default="safe",
+                        help="which commands batch mode may run unattended (default: safe)")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write batch results to FILE instead of stdout")
+    parser.add_argument("--crontab", metavar="FILE",
+                        help="manage FILE instead of the user's crontab (e.g. for testing schedules locally)")
+    parser.add_argument("--check-startup", metavar="MS", type=float, nargs="?", const=STARTUP_BUDGET_MS,
+                        help="measure import and start-up time and fail if it exceeds MS "
+                             f"(default {STARTUP_BUDGET_MS:g}) or an AI SDK is imported eagerly")
+    parser.add_argument("--check-classifier", metavar="FILE", nargs="?", const=CLASSIFIER_CORPUS,
+                        help="classify every command in a JSONL corpus, report mismatches and the "
+                             "per-command cost in microseconds (default: fixtures/classifier_corpus.jsonl)")
+    parser.add_argument("--check-batch", metavar="N", type=int, nargs="?", const=300,
+                        help="run N mixed batch requests (default 300) at --concurrency against a fake "
+                             "model and report requests per second")
+    parser.add_argument("--check-routing", action="store_true",
+                        help="run the provider routing scenarios (hedging, failover, auto ranking) "
+                             "against fake providers")
+    return parser.parse_args(argv)
+
+FAKE_PLAN = json.dumps({"analysis": "Benchmark plan", "commands": ["true", "echo done"],
+                        "rollback": ["", ""]})
+
+def check_batch(requests: int, concurrency: int, latency: float = 0.05) -> int:
+    """Time BatchRunner on a mix of requests against a fake model; 1 if any request fails"""
+    provider = FakeProvider("deepseek", reply=FAKE_PLAN, delay=latency)
+    assistant = SimpleLinuxAssistant(AIModel.DEEPSEEK, interactive=False, providers={AIModel.DEEPSEEK: provider})
+    # Keep the run off the user's history and cache; a cache would also hide the model latency
+    assistant.history = HistoryStore(":memory:")
+    assistant.response_cache = ResponseCache(":memory:", enabled=False)
+    kinds = ({"type": "task", "input": "benchmark task {}"}, {"type": "ask", "input": "question {}"},
+             {"type": "command", "input": "echo request {}"})
+    lines = [json.dumps(dict(kinds[i % 3], id=i, input=kinds[i % 3]["input"].format(i))) for i in range(requests)]
+    output = io.StringIO()
+    start = time.perf_counter()
+    try:
+        counts = BatchRunner(assistant, concurrency, "safe", output).run(lines)
+    finally:
+        elapsed = time.perf_counter() - start
+        assistant.close()
+    print(f"{requests} requests in {elapsed:.2f} s: {requests / elapsed:.1f} requests/s "
+          f"at concurrency {concurrency} ({latency * 1000:g} ms model latency, {provider.calls} model calls); "
+          f"{counts}")
+    return 0 if set(counts) <= {"ok"} else 1
+
+# name, primary and backup FakeProvider settings, router settings, requests, expected outcome of the last request
+ROUTING_SCENARIOS = [
+    ("fast primary", {"delay": 0.01}, {"delay": 0.01}, {}, 1,
+     {"reply": "primary", "hedges": 0, "failovers": 0, "backup_wins": 0, "backup.calls": 0}),
+    ("hedge win", {"delay": 0.5}, {"delay": 0.01}, {}, 1,
+     {"reply": "backup", "hedges": 1, "failovers": 0, "backup_wins": 1, "primary.cancelled": 1}),
+    ("failover", {"delay": 0.01, "fail": ConnectionError("refused")}, {"delay": 0.01}, {}, 1,
+     {"reply": "backup", "hedges": 0, "failovers": 1, "backup_wins": 1}),
+    ("all failing", {"delay": 0.01, "fail": ConnectionError("refused")},
+     {"delay": 0.01, "fail": ConnectionError("refused")}, {}, 1,
+     {"error": "ConnectionError", "hedges": 0, "failovers": 1, "backup.calls": 1}),
+    ("hedging off", {"delay": 0.2}, {"delay": 0.01}, {"hedging": False}, 1,
+     {"reply": "primary", "hedges": 0, "backup.calls": 0}),
+    ("primary wins after hedge", {"delay": 0.15}, {"delay": 0.5}, {}, 1,
+     {"reply": "primary", "hedges": 1, "backup_wins": 0, "backup.cancelled": 1}),
+    # Both start unmeasured; once each has MIN_SAMPLES the faster backup ranks first
+    ("auto ranking", {"delay": 0.05}, {"delay": 0.005}, {"hedging": False, "auto": True}, 12,
+     {"reply": "backup", "primary.calls": 5, "backup.calls": 7, "backup_wins": 0}),
+]
+
+async def _run_scenario(kind: str, primary: Dict, backup: Dict, settings: Dict, requests: int) -> Dict:
+    providers = {AIModel.DEEPSEEK: FakeProvider("primary", reply="primary", **primary),
+                 AIModel.GEMINI: FakeProvider("backup", reply="backup", **backup)}
+    settings = dict(settings)
+    auto = settings.pop("auto", False)
+    router = ProviderRouter(providers, lambda: AIModel.DEEPSEEK, **dict({"hedge_after": 0.05}, **settings))
+    router.auto = auto
+    messages = [{"role": "user", "content": "ping"}]
+    observed = {}
+    for _ in range(requests):
+        try:
+            if kind == "complete":
+                observed["reply"] = await router.complete(messages)
+            else:
+                observed["reply"] = "".join([chunk async for chunk in router.stream(messages)])
+        except Exception as e:
+            observed["error"] = type(e).__name__
+    observed.update(hedges=router.hedges, failovers=router.failovers, backup_wins=router.backup_wins)
+    for label, provider in zip(("primary", "backup"), providers.values()):
+        observed[f"{label}.calls"] = provider.calls
+        observed[f"{label}.cancelled"] = provider.cancelled
+    return observed
+
+def check_routing() -> int:
+    """Run ProviderRouter through ROUTING_SCENARIOS with fake providers; 1 on any unexpected outcome"""
+    failures = 0
+    for name, primary, backup, settings, requests, expected in ROUTING_SCENARIOS:
+        for kind in ("complete", "stream"):
+            start = time.perf_counter()
+            observed = asyncio.run(_run_scenario(kind, primary, backup, settings, requests))
+            elapsed = (time.perf_counter() - start) * 1000
+            wrong = {key: observed.get(key) for key, value in expected.items() if observed.get(key) != value}
+            failures += bool(wrong)
+            print(f"  {'ok  ' if not wrong else 'FAIL'} {name} ({kind}, {elapsed:.0f} ms)"
+                  + "".join(f"; {key} = {value!r}, expected {expected[key]!r}" for key, value in wrong.items()))
+    total = len(ROUTING_SCENARIOS) * 2
+    print(f"{total - failures}/{total} routing scenarios behaved as expected")
+    return 1 if failures else 0
+
+CLASSIFIER_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "classifier_corpus.jsonl")
+
+def check_classifier(path: str, rounds: int = 20) -> int:
+    """Check CommandClassifier against a corpus of {"command", "level"} lines; 1 on any mismatch"""
+    with open(path) as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+    classifier = CommandClassifier()
+    mismatches = []
+    for case in cases:
+        risk = classifier.classify(case["command"])
+        if risk.level.name != case["level"]:
+            mismatches.append((case, risk))
+    # Time the uncached path: the lru_cache would otherwise measure dictionary lookups
+    classify = CommandClassifier._classify.__wrapped__
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for case in cases:
+            classify(classifier, case["command"], 0)
+    per_command = (time.perf_counter() - start) / (rounds * len(cases)) * 1e6
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for case in cases:
+            classifier.classify(case["command"])
+    cached = (time.perf_counter() - start) / (rounds * len(cases)) * 1e6
+    for case, risk in mismatches:
+        print(f"  expected {case['level']:<8} got {risk.level.name:<8} {case['command']}  {'; '.join(risk.reasons)}")
+    print(f"{len(cases) - len(mismatches)}/{len(cases)} commands classified as expected; "
+          f"{per_command:.1f} µs per command ({cached:.2f} µs cached)")
+    return 1 if mismatches else 0
+
+STARTUP_BUDGET_MS = 300
+# Imported only when the matching provider is first used
+LAZY_MODULES = ("openai", "httpx", "google.generativeai", "grpc")
+
+STARTUP_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module} as agent
+imported = time.perf_counter()
+eager = [name for name in {lazy!r} if name in sys.modules]
+assistant = agent.SimpleLinuxAssistant(agent.AIModel.DEEPSEEK, interactive=False)
+ready = time.perf_counter()
+assistant.close()
+print(json.dumps({{"import_ms": (imported - start) * 1000, "ready_ms": (ready - start) * 1000, "eager": eager}}))
+"""
+
+def check_startup(budget_ms: float) -> int:
+    """Time a fresh import and assistant start-up under -X importtime; 1 if over budget_ms or an SDK loads eagerly"""
+    directory, filename = os.path.split(os.path.abspath(__file__))
+    env = dict(os.environ, DEEPSEEK_API_KEY=os.environ.get("DEEPSEEK_API_KEY") or "startup-check",
+               PYTHONPATH=os.pathsep.join(filter(None, [directory, os.environ.get("PYTHONPATH")])))
+    code = STARTUP_PROBE.format(module=os.path.splitext(filename)[0], lazy=LAZY_MODULES)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            capture_output=True, text=True, env=env, cwd=directory)
+    if result.returncode != 0:
+        print(result.stderr[-2000:], file=sys.stderr)
+        return 1
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    # Direct imports of the module, nested one level in "import time: self | cumulative | name"
+    imports = []
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s*(\d+) \|\s*(\d+) \|   (\S.*)$", line)
+        if match:
+            imports.append((int(match.group(2)) / 1000, match.group(3)))
+    print(f"import: {report['import_ms']:.1f} ms, ready for first prompt: {report['ready_ms']:.1f} ms "
+          f"(budget {budget_ms:g} ms)")
+    for ms, name in sorted(imports, reverse=True)[:5]:
+        print(f"  {ms:8.1f} ms  {name}")
+    failed = False
+    if report["eager"]:
+        print(f"Imported at start-up but should be lazy: {', '.join(report['eager'])}")
+        failed = True
+    if report["ready_ms"] > budget_ms:
+        print(f"Start-up exceeds the {budget_ms:g} ms budget")
+        failed = True
+    return 1 if failed else 0
+
+def run_batch(args: argparse.Namespace) -> int:
+    if not args.model:
+        print("--model is required in batch mode", file=sys.stderr)
+        return 2
+    assistant = SimpleLinuxAssistant(AIModel(args.model), interactive=False)
+    if args.crontab:
+        assistant.crontab = CrontabManager(args.crontab)
+    if assistant.ai_model not in assistant.clients:
+        assistant.close()
+        return 2
+    source = sys.stdin if args.batch == "-" else open(args.batch)
+    output = open(args.output, "a") if args.output else sys.stdout
+    try:
+        counts = BatchRunner(assistant, args.concurrency, args.auto_confirm, output).run(source)
+    finally:
+        assistant.close()
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+    print(f"Processed {sum(counts.values())} requests: {counts}", file=sys.stderr)
+    return 0 if set(counts) <= {"ok", "recovered", "unchanged"} else 1
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.check_startup is not None:
+        sys.exit(check_startup(args.check_startup))
+    if args.check_classifier:
+        sys.exit(check_classifier(args.check_classifier))
+    if args.check_batch:
+        sys.exit(check_batch(args.check_batch, args.concurrency))
+    if args.check_routing:
+        sys.exit(check_routing())
+    if args.batch:
+        sys.exit(run_batch(args))
+
+    if args.model:
+        initial_model = AIModel(args.model)
+    else:
+        print("Available AI models:")
+        for model in AIModel:
+            print(f"  - {model.value}")
+        
+        while True:
+            model_choice = input("\nChoose initial model (deepseek/gemini): ").strip().lower()
+            try:
+                initial_model = AIModel(model_choice)
+                break
+            except ValueError:
+                print(f"Invalid model! Please choose from {[m.value for m in AIModel]}")
     
     assistant = SimpleLinuxAssistant(initial_model)
+    if args.crontab:
+        assistant.crontab = CrontabManager(args.crontab)
     try:
         assistant.run()
     except KeyboardInterrupt: